@@ -0,0 +1,144 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Grouping of samples into batches that are run on one node each.
+
+Samples are weighted by number of sample runs or by total size of
+their fastq files, and packed into batches so that the estimated work
+per batch is balanced. Packing uses the longest processing time rule:
+samples are assigned in order of decreasing weight to the batch with
+the least load that has room for another sample.
+
+"""
+import os
+import glob
+import heapq
+import logging
+from ratatosk.ext.scilife.illumina import is_fastq, parse_fastq_filename
+
+PACK_BY = ["count", "runs", "bytes"]
+
+def fastq_files(smp):
+    """Get the fastq files of a sample run.
+
+    :param smp: :class:`ratatosk.experiment.Sample` object; only the files of its chunk for a :class:`ratatosk.ext.scilife.chunks.ChunkSample`
+
+    :returns: list of fastq file names
+    """
+    prefix = smp.prefix("sample_run")
+    chunk = getattr(smp, "chunk", None)
+    fqfiles = []
+    for f in glob.glob(prefix + "_*"):
+        if not is_fastq(f):
+            continue
+        fqname = parse_fastq_filename(f)
+        if not fqname or fqname.prefix != prefix:
+            continue
+        if chunk is None or fqname.chunk == chunk:
+            fqfiles.append(f)
+    return fqfiles
+
+def fastq_bytes(runs):
+    """Get the total size of the fastq files of a list of sample runs.
+
+    :param runs: list of :class:`ratatosk.experiment.Sample` objects
+
+    :returns: size in bytes
+    """
+    size = 0
+    for smp in runs:
+        for f in fastq_files(smp):
+            try:
+                size += os.stat(f).st_size
+            except OSError:
+                logging.warn("Could not stat fastq file {}".format(f))
+    return size
+
+def sample_weight(runs, pack_by="count"):
+    """Get the weight of a sample.
+
+    :param runs: list of sample runs of the sample
+    :param pack_by: one of 'count' (every sample weighs 1), 'runs' (number of sample runs) or 'bytes' (total fastq size)
+
+    :returns: sample weight
+    """
+    if pack_by == "count":
+        return 1
+    elif pack_by == "runs":
+        return len(runs)
+    elif pack_by == "bytes":
+        return fastq_bytes(runs)
+    raise ValueError("invalid pack_by value '{}'; must be one of {}".format(pack_by, ", ".join(PACK_BY)))
+
+def pack_batches(weights, batch_size):
+    """Pack samples into batches with balanced total weight.
+
+    The number of batches is the same as when splitting the sorted
+    samples into batches of batch_size samples, and no batch gets
+    more than batch_size samples. If all weights are equal, the
+    samples are split in sorted order.
+
+    :param weights: dictionary mapping sample names to weights
+    :param batch_size: maximum number of samples per batch
+
+    :returns: list of batches, where each batch is a sorted list of sample names
+    """
+    names = sorted(weights.keys())
+    if len(set(weights.values())) <= 1:
+        return [names[x:x+batch_size] for x in range(0, len(names), batch_size)]
+    nbatches = (len(names) + batch_size - 1) // batch_size
+    heap = [(0, i) for i in range(nbatches)]
+    batches = [[] for i in range(nbatches)]
+    for name in sorted(names, key=lambda x:(-weights[x], x)):
+        (load, i) = heapq.heappop(heap)
+        batches[i].append(name)
+        # Full batches are not returned to the heap
+        if len(batches[i]) < batch_size:
+            heapq.heappush(heap, (load + weights[name], i))
+    return [sorted(x) for x in batches if x]
+
+def final_target(runs, suffix):
+    """Get the final target of a sample, named as the sample targets
+    of :func:`ratatosk.ext.scilife.sample.collect_sample_runs`.
+
+    :param runs: list of sample runs of the sample
+    :param suffix: target suffix, e.g. '.sort.merge.bam'
+
+    :returns: target file name
+    """
+    return "{}{}".format(runs[0].prefix("sample"), suffix.lstrip("\\"))
+
+def incomplete_samples(samples, suffix):
+    """Get the samples whose final target does not exist.
+
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param suffix: target suffix
+
+    :returns: sorted list of sample names
+    """
+    return sorted([k for k, v in samples.items() if not os.path.exists(final_target(v, suffix))])
+
+def batch_load_report(batches, samples):
+    """Summarize the predicted load of each batch.
+
+    :param batches: list of batches of sample names
+    :param samples: dictionary mapping sample names to lists of sample runs
+
+    :returns: list of dictionaries with keys batch, samples, runs and bytes
+    """
+    report = []
+    for i, batch in enumerate(batches):
+        runs = [smp for name in batch for smp in samples[name]]
+        report.append({'batch' : i + 1, 'samples' : len(batch), 'runs' : len(runs), 'bytes' : fastq_bytes(runs)})
+    return report
@@ -18,43 +18,67 @@ import logging
 import yaml
 import cStringIO
 from datetime import datetime
+from ratatosk.ext.scilife.cache import LRUCache
+
+# Use the C-accelerated yaml loader if available
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Converted bcbio config files, keyed by path and modification time
+_ssheet_cache = LRUCache(maxsize=1024)
+
 def bcbio_config_to_sample_sheet(config, save=True):
     """Convert bcbio config file to standard Illumina SampleSheet format. 
 
+    Conversions are cached by file path and modification time, so a
+    config file is only parsed once per process unless it changes.
+
     :param config: bcbio config file
-    :param save: save results to SampleSheet.csv
+    :param save: save results to SampleSheet.csv, unless an up to date SampleSheet.csv already exists
 
     :returns: SampleSheet-formatted configuration (list of lists)
     """
     keys = ["FCID", "Lane", "SampleID", "SampleRef", "Index",
               "Description" , "Control", "Recipe", "Operator", "SampleProject"]
-    with open(config) as fh:
-        runinfo_yaml = yaml.load(fh)
-    runinfo = runinfo_yaml.get("details", None) if runinfo_yaml.get("details", None) else runinfo_yaml
-    ssheet = []
-    for info in runinfo:
-        for mp in info["multiplex"]:
-            item = {"FCID":info.get("flowcell_id", None),
-                    "Lane":info.get("lane", None),
-                    "SampleRef":info.get("genome_build", None),
-                    "Control":"N",
-                    "Recipe":"R1",
-                    "Operator":"NN",
-                    "SampleID":mp.get("name"),
-                    "Index":mp.get("sequence"),
-                    "Description":mp.get("sample_prj").replace(".", "__"),
-                    "SampleProject":mp.get("sample_prj")
-                    }
-            ssheet.append(item)
-    if save:
+    mtime = os.stat(config).st_mtime
+    cache_key = (os.path.abspath(config), mtime)
+    ssheet = _ssheet_cache.get(cache_key)
+    if ssheet is None:
+        with open(config) as fh:
+            runinfo_yaml = yaml.load(fh, Loader=Loader)
+        runinfo = runinfo_yaml.get("details", None) if runinfo_yaml.get("details", None) else runinfo_yaml
+        ssheet = []
+        for info in runinfo:
+            for mp in info["multiplex"]:
+                item = {"FCID":info.get("flowcell_id", None),
+                        "Lane":info.get("lane", None),
+                        "SampleRef":info.get("genome_build", None),
+                        "Control":"N",
+                        "Recipe":"R1",
+                        "Operator":"NN",
+                        "SampleID":mp.get("name"),
+                        "Index":mp.get("sequence"),
+                        "Description":mp.get("sample_prj").replace(".", "__"),
+                        "SampleProject":mp.get("sample_prj")
+                        }
+                ssheet.append(item)
+        _ssheet_cache.set(cache_key, ssheet)
+    outfile = os.path.join(os.path.dirname(config), "SampleSheet.csv")
+    if save and os.path.exists(outfile) and os.stat(outfile).st_mtime >= mtime:
+        logging.debug("SampleSheet.csv up to date with yaml file {}; not saving".format(config))
+    elif save:
         logging.info("Saving SampleSheet.csv based on yaml file {}".format(config))
-        fh = file(os.path.join(os.path.dirname(config), "SampleSheet.csv"), "w")
-        fh.write("# Generated SampleSheet.csv from {} {} by {}\n".format(config, datetime.today().strftime("at %H:%M on %A %d, %B %Y"), __name__))
-        fh.write(",".join(keys) + "\n")
-        writer = csv.DictWriter(fh, fieldnames=keys)
-        writer.writerows(ssheet)
-        fh.close()
-    return ssheet
+        # Write to a temporary file and rename so that readers never
+        # see a partially written sample sheet
+        tmpfile = "{}.tmp{}".format(outfile, os.getpid())
+        with open(tmpfile, "w") as fh:
+            fh.write("# Generated SampleSheet.csv from {} {} by {}\n".format(config, datetime.today().strftime("at %H:%M on %A %d, %B %Y"), __name__))
+            fh.write(",".join(keys) + "\n")
+            writer = csv.DictWriter(fh, fieldnames=keys)
+            writer.writerows(ssheet)
+        os.rename(tmpfile, outfile)
+    return [dict(x) for x in ssheet]
@@ -0,0 +1,314 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Micro-benchmarks for the scilife extension. Run as
+
+.. code-block:: text
+
+   python -m ratatosk.ext.scilife.bench parser -n 1000000
+   python -m ratatosk.ext.scilife.bench startup -o startup.json HaloPlex --indir indir
+   python -m ratatosk.ext.scilife.bench compare old.json new.json
+
+The startup benchmark measures the cold-start cost of
+:program:`ratatosk_run_scilife.py`: import time per module, time to
+set up configuration and global handlers, and time until luigi makes
+its first scheduling decision (running the task with ``--dry-run``).
+Every measurement is made in a fresh interpreter. The resulting JSON
+reports can be compared across versions with ``compare``.
+
+"""
+import os
+import re
+import sys
+import time
+import json
+import socket
+import runpy
+import argparse
+import subprocess
+from datetime import datetime
+from ratatosk.ext.scilife import illumina
+
+def synthetic_fastq_names(n, fc_dir="/proj/J.Doe_00_01/P001_101_index3/120924_AC003CCCXX"):
+    """Generate synthetic Illumina fastq file names.
+
+    :param n: number of file names
+    :param fc_dir: flowcell directory
+
+    :returns: list of file paths
+    """
+    return [os.path.join(fc_dir, "P001_{}_index{}_TGACCA_L00{}_R{}_{:03d}.fastq.gz".format(i // 128, i % 12, i % 8 + 1, i % 2 + 1, i % 100 + 1)) for i in range(n)]
+
+def _legacy_parse(fq, fc_dir):
+    """File name parsing as previously done in generic_target_generator"""
+    if not re.match(".*(.fastq$|.fastq.gz$|.fq$|.fq.gz$)", fq):
+        return None
+    m = re.match("(.*)_[0-9]+(.fastq$|.fastq.gz$|.fq$|.fq.gz$)", fq)
+    if not m:
+        return None
+    sample_run_prefix = m.group(1)
+    if re.search("L[0-9]+_R[12]", sample_run_prefix):
+        sample_run_prefix=os.path.join(fc_dir, os.path.basename(m.group(1).rstrip("R[12]").rstrip("_")))
+    return sample_run_prefix
+
+def _parse(fq, fc_dir):
+    fqname = illumina.parse_fastq_filename(fq)
+    if not fqname:
+        return None
+    if fqname.read:
+        return os.path.join(fc_dir, os.path.basename(fqname.prefix))
+    return fqname.prefix
+
+def bench_parser(n):
+    """Measure fastq file name parsing throughput.
+
+    :param n: number of synthetic file names
+
+    :returns: dictionary of results
+    """
+    fc_dir = "/proj/J.Doe_00_01/P001_101_index3/120924_AC003CCCXX"
+    names = synthetic_fastq_names(n, fc_dir)
+    results = {'n' : n}
+    for label, fn in [("legacy", _legacy_parse), ("parser", _parse)]:
+        illumina._cache.clear()
+        t0 = time.time()
+        for fq in names:
+            fn(fq, fc_dir)
+        elapsed = time.time() - t0
+        results[label] = {'seconds' : elapsed, 'names_per_second' : n / elapsed if elapsed > 0 else None}
+    # Repeated parsing of a working set that fits in the parser cache
+    working_set = names[0:min(n, illumina._CACHE_SIZE // 2)]
+    illumina._cache.clear()
+    t0 = time.time()
+    for i in range(n // len(working_set) if working_set else 0):
+        for fq in working_set:
+            _parse(fq, fc_dir)
+    elapsed = time.time() - t0
+    results["parser_cached"] = {'seconds' : elapsed, 'names_per_second' : n / elapsed if elapsed > 0 else None}
+    return results
+
+# Prefix of the line with the measured times printed by the code
+# below, so that other output of the measured code is ignored
+_MARKER = "ratatosk-bench:"
+
+# Run in a fresh interpreter; prints elapsed time for the import
+_IMPORT_CODE = """
+import time
+t0 = time.time()
+import {mod}
+print("{marker} {{}}".format(time.time() - t0))
+"""
+
+# Run in a fresh interpreter; prints elapsed times for configuration
+# setup and handler registration
+_SETUP_CODE = """
+import time
+from ratatosk.config import setup_config
+from ratatosk.handler import setup_global_handlers
+t0 = time.time()
+setup_config(config_file={config!r}, custom_config_file={custom_config!r})
+t1 = time.time()
+setup_global_handlers()
+t2 = time.time()
+print("{marker} {{}} {{}}".format(t1 - t0, t2 - t1))
+"""
+
+# Run in a fresh interpreter; runs the run script until the first
+# scheduling decision, then prints the elapsed time and exits
+_RUN_CODE = """
+import os
+import sys
+import time
+import runpy
+t0 = time.time()
+import luigi
+def _first_decision(*args, **kwargs):
+    sys.stdout.write("\\n{marker} {{}}\\n".format(time.time() - t0))
+    sys.stdout.flush()
+    os._exit(0)
+event = getattr(getattr(luigi, "Event", None), "DEPENDENCY_DISCOVERED", None)
+if event:
+    luigi.Task.event_handler(event)(_first_decision)
+sys.argv = {argv!r}
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    sys.stdout.write("\\n{marker} {{}}\\n".format(time.time() - t0))
+"""
+
+def _parse_times(out):
+    """Get the times of the last marker line of output out, or None
+    if there is no such line"""
+    lines = [x for x in out.splitlines() if x.startswith(_MARKER)]
+    if not lines:
+        return None
+    try:
+        return [float(x) for x in lines[-1][len(_MARKER):].split()]
+    except ValueError:
+        return None
+
+def _time_code(code, repeat=3):
+    """Run code in fresh interpreters and return the minimum of each
+    printed time over repeat runs, or None if code failed"""
+    best = None
+    for i in range(repeat):
+        proc = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            return None
+        times = _parse_times(out.decode())
+        if times is None:
+            return None
+        best = times if best is None else [min(x, y) for x, y in zip(best, times)]
+    return best
+
+def _time_process(argv, repeat=3):
+    """Return the minimum wall time of running argv over repeat runs"""
+    best = None
+    for i in range(repeat):
+        with open(os.devnull, "w") as devnull:
+            t0 = time.time()
+            subprocess.call(argv, stdout=devnull, stderr=subprocess.STDOUT)
+            elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("ratatosk.ext.scilife").version
+    except Exception:
+        return None
+
+def bench_startup(task=None, task_args=(), config_file=None, custom_config=None, script=None, repeat=3):
+    """Measure the startup cost of ratatosk_run_scilife.py.
+
+    :param task: task to run; if in :attr:`ratatosk.ext.scilife.config.config_dict`, its configuration file is used
+    :param task_args: extra arguments passed to the task
+    :param config_file: configuration file
+    :param custom_config: custom configuration file
+    :param script: path to ratatosk_run_scilife.py; looked up in PATH if None
+    :param repeat: number of repetitions for each measurement; the minimum is reported
+
+    :returns: dictionary of results
+    """
+    from ratatosk.utils import which
+    from ratatosk.ext.scilife.config import config_dict, config_modules
+    script = script or (which("ratatosk_run_scilife.py") or [None])[0]
+    results = {'benchmark' : "startup",
+               'date' : datetime.now().isoformat(),
+               'host' : socket.gethostname(),
+               'python' : sys.version.split()[0],
+               'version' : _version(),
+               'task' : task,
+               'repeat' : repeat}
+    if task in config_dict and not config_file:
+        config_file = config_dict[task]['config']
+    # Look up the task class path without importing it
+    cls = dict.get(config_dict[task], 'cls') if task in config_dict else None
+    if cls:
+        modules = [cls.rsplit(".", 1)[0]] + config_modules(config_file, custom_config)
+    elif script:
+        modules = runpy.run_path(script, run_name="ratatosk_run_scilife")['TASK_MODULES']
+    else:
+        modules = []
+    modules = ["luigi", "yaml", "ratatosk.config", "ratatosk.handler", "ratatosk.ext.scilife.config"] + modules
+    results['interpreter'] = _time_process([sys.executable, "-c", "pass"], repeat)
+    results['imports'] = {}
+    for mod in modules:
+        t = _time_code(_IMPORT_CODE.format(mod=mod, marker=_MARKER), repeat)
+        results['imports'][mod] = t[0] if t else None
+    t = _time_code(_SETUP_CODE.format(config=config_file, custom_config=custom_config, marker=_MARKER), repeat)
+    results['setup_config'] = t[0] if t else None
+    results['setup_global_handlers'] = t[1] if t else None
+    results['first_scheduling_decision'] = None
+    if script and task:
+        argv = [script, task, "--dry-run", "--local-scheduler"] + list(task_args)
+        if config_file and not task in config_dict:
+            argv += ["--config-file", config_file]
+        if custom_config:
+            argv += ["--custom-config", custom_config]
+        t = _time_code(_RUN_CODE.format(argv=argv, marker=_MARKER), repeat)
+        results['first_scheduling_decision'] = t[0] if t else None
+    return results
+
+def _flatten(d, prefix=""):
+    """Flatten nested dictionary of numbers to dotted keys"""
+    flat = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[prefix + k] = v
+    return flat
+
+def compare_reports(old, new, threshold=0.1, exclude=("repeat", "n")):
+    """Compare two benchmark reports.
+
+    :param old: old report
+    :param new: new report
+    :param threshold: relative increase in time that counts as a regression
+    :param exclude: keys that are not timings
+
+    :returns: list of (key, old value, new value, relative change, regression) tuples
+    """
+    (flat_old, flat_new) = (_flatten(old), _flatten(new))
+    rows = []
+    for key in sorted(set(flat_old.keys()) & set(flat_new.keys())):
+        if key in exclude or key.endswith("names_per_second"):
+            continue
+        (a, b) = (flat_old[key], flat_new[key])
+        change = (b - a) / a if a else 0.0
+        rows.append((key, a, b, change, change > threshold))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="scilife extension benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    p = subparsers.add_parser("parser", help="fastq file name parser throughput")
+    p.add_argument("-n", type=int, default=1000000, help="number of synthetic file names")
+    p = subparsers.add_parser("startup", help="ratatosk_run_scilife.py startup time")
+    p.add_argument("task", nargs="?", default=None, help="task to run until the first scheduling decision")
+    p.add_argument("task_args", nargs=argparse.REMAINDER, help="arguments passed to the task")
+    p.add_argument("--config-file", default=None, help="configuration file")
+    p.add_argument("--custom-config", default=None, help="custom configuration file")
+    p.add_argument("--script", default=None, help="path to ratatosk_run_scilife.py")
+    p.add_argument("-r", "--repeat", type=int, default=3, help="repetitions per measurement")
+    p.add_argument("-o", "--output", default=None, help="output JSON report")
+    p = subparsers.add_parser("compare", help="compare two JSON reports")
+    p.add_argument("old", help="old report")
+    p.add_argument("new", help="new report")
+    p.add_argument("-t", "--threshold", type=float, default=0.1, help="relative increase in time that counts as a regression")
+    pargs = parser.parse_args(argv)
+    if pargs.benchmark == "compare":
+        with open(pargs.old) as fh:
+            old = json.load(fh)
+        with open(pargs.new) as fh:
+            new = json.load(fh)
+        rows = compare_reports(old, new, pargs.threshold)
+        for (key, a, b, change, regression) in rows:
+            sys.stdout.write("{:<60} {:>10.4f} {:>10.4f} {:>+8.1%}{}\n".format(key, a, b, change, "  REGRESSION" if regression else ""))
+        sys.exit(1 if any(x[4] for x in rows) else 0)
+    if pargs.benchmark == "parser":
+        results = bench_parser(pargs.n)
+    elif pargs.benchmark == "startup":
+        results = bench_startup(pargs.task, pargs.task_args, pargs.config_file, pargs.custom_config, pargs.script, pargs.repeat)
+    if getattr(pargs, "output", None):
+        with open(pargs.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Provides a small thread-safe in-memory cache with least recently used
+eviction and optional time to live, used to memoize file system
+lookups within a process.
+
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Least recently used cache with optional time to live.
+
+    :param maxsize: maximum number of entries; the least recently used entry is evicted when exceeded
+    :param ttl: time to live in seconds, or None for entries that never expire
+    """
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get value for key, or default if key is missing or has
+        expired"""
+        with self._lock:
+            if not key in self._data:
+                return default
+            (value, stamp) = self._data.pop(key)
+            if self.ttl is not None and time.time() - stamp > self.ttl:
+                return default
+            self._data[key] = (value, stamp)
+            return value
+
+    def set(self, key, value):
+        """Set value for key"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Invalidate key. If key is None, invalidate all entries."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def keys(self):
+        """Get cached keys, least recently used first"""
+        with self._lock:
+            return list(self._data.keys())
+
+    def __len__(self):
+        return len(self._data)
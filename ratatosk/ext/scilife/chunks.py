@@ -0,0 +1,150 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Chunk-level targets.
+
+Illumina sequence read files are split in chunks, e.g.
+
+.. code-block:: text
+
+   P001_101_index3_TGACCA_L002_R1_001.fastq.gz
+   P001_101_index3_TGACCA_L002_R1_002.fastq.gz
+
+A :class:`ChunkSample` is a sample run restricted to one chunk. The
+target generators return chunk-level targets if called with
+``chunks=True``, and the chunks of a sample run can be aligned
+independently and merged back into the sample run with
+:class:`ratatosk.ext.scilife.fused.ChunkSampeSortSam` and
+:class:`ratatosk.ext.scilife.fused.MergeChunks`. Chunk targets are
+named by adding :data:`CHUNK_LABEL` and the chunk number to the
+sample run prefix, e.g. P001_101_index3_TGACCA_L002.chunk002.
+
+"""
+import os
+import re
+import glob
+from ratatosk import backend
+from ratatosk.experiment import Sample
+from ratatosk.ext.scilife.illumina import is_fastq, parse_fastq_filename
+
+CHUNK_LABEL = ".chunk"
+CHUNK_RE = re.compile(r"^(.*){}([0-9]+)$".format(re.escape(CHUNK_LABEL)))
+
+class ChunkSample(Sample):
+    """Sample run chunk.
+
+    :param chunk: chunk number as string, e.g. '002'
+    """
+    def __init__(self, chunk=None, **kwargs):
+        Sample.__init__(self, **kwargs)
+        self.chunk = chunk
+
+    def chunk_prefix(self):
+        """Get the prefix of the chunk targets"""
+        return chunk_prefix(self.prefix("sample_run"), self.chunk)
+
+def chunk_prefix(prefix, chunk):
+    """Get the prefix of the targets of a chunk.
+
+    :param prefix: sample run prefix
+    :param chunk: chunk number
+
+    :returns: chunk prefix
+    """
+    return "{}{}{}".format(prefix, CHUNK_LABEL, chunk)
+
+def split_chunk_prefix(prefix):
+    """Split a chunk prefix into sample run prefix and chunk number.
+
+    :param prefix: chunk prefix
+
+    :returns: tuple (sample run prefix, chunk), where chunk is None if prefix is not a chunk prefix
+    """
+    m = CHUNK_RE.match(prefix)
+    if not m:
+        return (prefix, None)
+    return m.groups()
+
+def rebase(smp, indir, outdir):
+    """Move a sample run from one project directory to another,
+    keeping its chunk number.
+
+    :param smp: :class:`ratatosk.experiment.Sample` object
+    :param indir: project directory of smp
+    :param outdir: new project directory
+
+    :returns: :class:`ratatosk.experiment.Sample` object
+    """
+    kwargs = {'project_id' : smp.project_id(), 'sample_id' : smp.sample_id(),
+              'project_prefix' : os.path.join(outdir, os.path.relpath(smp.prefix("project"), indir)),
+              'sample_prefix' : os.path.join(outdir, os.path.relpath(smp.prefix("sample"), indir)),
+              'sample_run_prefix' : os.path.join(outdir, os.path.relpath(smp.prefix("sample_run"), indir))}
+    if getattr(smp, "chunk", None) is not None:
+        return ChunkSample(chunk=smp.chunk, **kwargs)
+    return Sample(**kwargs)
+
+def fastq_chunks(prefix):
+    """Get the chunk numbers of the fastq files of a sample run.
+
+    :param prefix: sample run prefix
+
+    :returns: sorted list of chunk numbers
+    """
+    chunks = set()
+    for f in glob.glob(prefix + "_*"):
+        if not is_fastq(f):
+            continue
+        fqname = parse_fastq_filename(f)
+        if fqname and fqname.prefix == prefix:
+            chunks.add(fqname.chunk)
+    return sorted(chunks)
+
+def expand_chunks(targets):
+    """Expand sample runs to one target per chunk. Duplicate sample
+    runs are collapsed, and chunk targets are kept as they are.
+
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects
+
+    :returns: list of :class:`ChunkSample` objects
+    """
+    chunks = []
+    seen = set()
+    for smp in targets:
+        if getattr(smp, "chunk", None) is not None:
+            keys = [smp.chunk]
+        else:
+            keys = fastq_chunks(smp.prefix("sample_run"))
+        for c in keys:
+            if (smp.prefix("sample_run"), c) in seen:
+                continue
+            seen.add((smp.prefix("sample_run"), c))
+            chunks.append(ChunkSample(chunk=c, project_id=smp.project_id(), sample_id=smp.sample_id(),
+                                      project_prefix=smp.prefix("project"), sample_prefix=smp.prefix("sample"),
+                                      sample_run_prefix=smp.prefix("sample_run")))
+    return chunks
+
+def run_chunks(prefix):
+    """Get the chunk numbers of a sample run, from the chunk targets
+    in backend.__global_vars__["targets"] if present, otherwise from
+    its fastq files.
+
+    :param prefix: sample run prefix
+
+    :returns: sorted list of chunk numbers
+    """
+    chunks = set([x.chunk for x in backend.__global_vars__.get("targets", None) or []
+                  if getattr(x, "chunk", None) is not None and x.prefix("sample_run") == prefix])
+    if chunks:
+        return sorted(chunks)
+    return fastq_chunks(prefix)
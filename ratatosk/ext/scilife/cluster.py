@@ -0,0 +1,227 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Job submission via drmaa.
+
+:class:`DrmaaSubmitter` opens one drmaa session and creates one job
+template that is reused for all submissions; only the job name,
+command and log paths are changed per job.
+
+The module can also be run as a script on compute nodes to wait
+until the scheduler daemon accepts connections:
+
+.. code-block:: text
+
+   python -m ratatosk.ext.scilife.cluster --host localhost --port 8082 --timeout 60
+
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+from ratatosk.ext.scilife.jobstate import normalize_jobid
+
+has_drmaa=False
+try:
+    import drmaa
+    has_drmaa=True
+except:
+    pass
+
+def _home_path(path, name=None):
+    """Express path relative to the drmaa home directory placeholder.
+    If path is a directory and name is set, name is appended to the
+    path."""
+    if name and os.path.isdir(path):
+        path = os.path.join(path, name)
+    return drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.relpath(path, os.getenv("HOME"))
+
+def dependency_ids(jobids):
+    """Get the job ids to pass in a job dependency. Array job tasks,
+    reported by drmaa as <array job id>.<task index>, are replaced by
+    their array job id, which is complete when all tasks are.
+
+    :param jobids: list of job ids
+
+    :returns: list of unique job ids in submission order
+    """
+    ids = []
+    for x in jobids:
+        jobid = normalize_jobid(x).split("_")[0]
+        if not jobid in ids:
+            ids.append(jobid)
+    return ids
+
+class DrmaaSubmitter(object):
+    """Submit jobs using a single drmaa session.
+
+    :param job_args: job arguments as returned by make_job_template_args in ratatosk_submit_job.py
+    :param dry_run: log commands instead of submitting them
+    """
+    def __init__(self, job_args, dry_run=False):
+        self.job_args = job_args
+        self.dry_run = dry_run
+        self.jobids = []
+        self._session = None
+        self._jt = None
+        self._native = None
+        self._elapsed = 0.0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Initialize session and create the job template"""
+        if self.dry_run or self._session is not None:
+            return
+        t0 = time.time()
+        self._session = drmaa.Session()
+        self._session.initialize()
+        self._jt = self._session.createJobTemplate()
+        self._jt.workingDirectory = _home_path(self.job_args['workingDirectory'])
+        self._native = "-t {time} -p {partition} -A {account} {extra}".format(**self.job_args)
+        self._jt.nativeSpecification = self._native
+        if self.job_args.get('email', None):
+            self._jt.email = [self.job_args.get('email')]
+        logging.info("Submitting jobs with native specification {}".format(self._native))
+        logging.info("Working directory: {}".format(self._jt.workingDirectory))
+        self._elapsed += time.time() - t0
+
+    def close(self):
+        """Delete job template, exit session and report submission
+        throughput"""
+        if self._session is not None:
+            try:
+                self._session.deleteJobTemplate(self._jt)
+            finally:
+                self._session.exit()
+                self._session = None
+                self._jt = None
+        if self.jobids:
+            logging.info("Submitted {} jobs in {:.2f} seconds ({:.1f} jobs/s)".format(len(self.jobids), self._elapsed, len(self.jobids) / self._elapsed if self._elapsed > 0 else float("inf")))
+
+    def _prepare(self, command, jobname, log_name=None, depends=None, walltime=None):
+        """Set the per-job fields of the job template"""
+        log_name = log_name or jobname
+        self._jt.remoteCommand = command
+        self._jt.jobName = jobname
+        native = self._native
+        if walltime:
+            native = "-t {time} -p {partition} -A {account} {extra}".format(**dict(self.job_args, time=walltime))
+        if depends:
+            native = "{} --dependency=afterok:{}".format(native.rstrip(), ":".join(dependency_ids(depends)))
+        self._jt.nativeSpecification = native
+        if native != self._native:
+            logging.info("Native specification: {}".format(native))
+        self._jt.outputPath = ":" + _home_path(self.job_args['outputPath'], log_name + "-drmaa.log")
+        self._jt.errorPath = ":" + _home_path(self.job_args['errorPath'], log_name + "-drmaa.err")
+        logging.info("Output logging: {}".format(self._jt.outputPath))
+        logging.info("Error logging: {}".format(self._jt.errorPath))
+
+    def submit(self, command, jobname, depends=None, walltime=None):
+        """Submit a job.
+
+        :param command: command to run
+        :param jobname: job name
+        :param depends: list of job ids that must complete successfully before the job starts; array job tasks are replaced by their array job
+        :param walltime: time limit formatted as hh:mm:ss; defaults to the time in job_args
+
+        :returns: job id, or None if dry run
+        """
+        if self.dry_run:
+            if depends:
+                logging.info("(DRY_RUN): job depends on {}".format(", ".join(depends)))
+            if walltime:
+                logging.info("(DRY_RUN): job time limit {}".format(walltime))
+            logging.info("(DRY_RUN): " + str(command) + "\n")
+            return None
+        self.open()
+        t0 = time.time()
+        self._prepare(command, jobname, depends=depends, walltime=walltime)
+        jobid = self._session.runJob(self._jt)
+        self._elapsed += time.time() - t0
+        logging.info('Your job has been submitted with id ' + jobid)
+        self.jobids.append(jobid)
+        return jobid
+
+    def submit_bulk(self, command, jobname, n, walltime=None):
+        """Submit a bulk (array) job with n tasks. The task index is
+        available to the command through the scheduler environment,
+        e.g. $SLURM_ARRAY_TASK_ID, and in log file names.
+
+        :param command: command to run
+        :param jobname: job name
+        :param n: number of tasks, indexed 1..n
+        :param walltime: time limit of each task formatted as hh:mm:ss; defaults to the time in job_args
+
+        :returns: list of job ids, or None if dry run
+        """
+        if self.dry_run:
+            logging.info("(DRY_RUN): array job with {} tasks: ".format(n) + str(command) + "\n")
+            return None
+        self.open()
+        t0 = time.time()
+        self._prepare(command, jobname, "{}_{}".format(jobname, drmaa.JobTemplate.PARAMETRIC_INDEX), walltime=walltime)
+        jobids = self._session.runBulkJobs(self._jt, 1, n, 1)
+        self._elapsed += time.time() - t0
+        logging.info('Your array job has been submitted with ids ' + ",".join(jobids))
+        self.jobids.extend(jobids)
+        return jobids
+
+def wait_for_scheduler(host="localhost", port=8082, timeout=60, interval=0.05, max_interval=2.0):
+    """Wait until the scheduler accepts connections. Polls the
+    scheduler port with exponential backoff.
+
+    :param host: scheduler host
+    :param port: scheduler port
+    :param timeout: maximum time to wait in seconds
+    :param interval: initial polling interval in seconds
+    :param max_interval: maximum polling interval in seconds
+
+    :returns: True if the scheduler is ready, False if timeout was reached
+    """
+    t0 = time.time()
+    while True:
+        try:
+            conn = socket.create_connection((host, port), timeout=max_interval)
+            conn.close()
+            logging.info("Scheduler at {}:{} ready after {:.2f} seconds".format(host, port, time.time() - t0))
+            return True
+        except (socket.error, socket.timeout):
+            pass
+        remaining = timeout - (time.time() - t0)
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="wait for scheduler to accept connections")
+    parser.add_argument("--host", default="localhost", help="scheduler host")
+    parser.add_argument("--port", type=int, default=8082, help="scheduler port")
+    parser.add_argument("--timeout", type=float, default=60, help="maximum time to wait in seconds")
+    pargs = parser.parse_args(argv)
+    if not wait_for_scheduler(pargs.host, pargs.port, pargs.timeout):
+        logging.error("Scheduler at {}:{} not ready after {} seconds; giving up".format(pargs.host, pargs.port, pargs.timeout))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
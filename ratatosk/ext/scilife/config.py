@@ -15,25 +15,88 @@
 Provides attribute :attr:`config_dict` that defines configuration file
 locations for predefined workflows.
 
+Task classes are stored as dotted paths and imported on first access
+of the ``cls`` item, so that importing this module does not import
+the ratatosk pipelines.
+
 """
 import os
+import sys
+import yaml
 import ratatosk.ext.scilife
-import ratatosk.pipeline
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+config_dir = os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife")
+
+def _import_object(path):
+    """Import an object given its dotted path"""
+    (mod, name) = path.rsplit(".", 1)
+    __import__(mod)
+    return getattr(sys.modules[mod], name)
+
+class ConfigEntry(dict):
+    """Workflow configuration entry. The ``cls`` item may be given as
+    a dotted path, in which case it is imported on first access."""
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key == 'cls' and isinstance(value, str):
+            value = _import_object(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
 
 config_dict = {
-    'ratatosk' : {'config':os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "ratatosk.yaml"),
-                  'cls':None},
-    'Align' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "align.yaml"),
-                     'cls' : ratatosk.pipeline.align.Align},
-    'SeqCap' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "seqcap.yaml"),
-                     'cls' : ratatosk.pipeline.seqcap.SeqCap},
-    'SeqCapSummary' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "seqcap.yaml"),
-                     'cls' : ratatosk.pipeline.seqcap.SeqCapSummary},
-    'HaloPlex' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "haloplex.yaml"),
-                  'cls' : ratatosk.pipeline.haloplex.HaloPlex},
-    'HaloPlexSummary' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "haloplex.yaml"),
-                         'cls' : ratatosk.pipeline.haloplex.HaloPlexSummary},
-    'HaloPlexCombine' : {'config' : os.path.join(ratatosk.ext.scilife.__path__[0], os.pardir, os.pardir, os.pardir, "config", "scilife", "haloplex.yaml"),
-                         'cls' : ratatosk.pipeline.haloplex.HaloPlexCombine},
+    'ratatosk' : ConfigEntry({'config':os.path.join(config_dir, "ratatosk.yaml"),
+                              'cls':None}),
+    'Align' : ConfigEntry({'config' : os.path.join(config_dir, "align.yaml"),
+                           'cls' : "ratatosk.pipeline.align.Align"}),
+    'SeqCap' : ConfigEntry({'config' : os.path.join(config_dir, "seqcap.yaml"),
+                            'cls' : "ratatosk.pipeline.seqcap.SeqCap"}),
+    'SeqCapSummary' : ConfigEntry({'config' : os.path.join(config_dir, "seqcap.yaml"),
+                                   'cls' : "ratatosk.pipeline.seqcap.SeqCapSummary"}),
+    'HaloPlex' : ConfigEntry({'config' : os.path.join(config_dir, "haloplex.yaml"),
+                              'cls' : "ratatosk.pipeline.haloplex.HaloPlex"}),
+    'HaloPlexSummary' : ConfigEntry({'config' : os.path.join(config_dir, "haloplex.yaml"),
+                                     'cls' : "ratatosk.pipeline.haloplex.HaloPlexSummary"}),
+    'HaloPlexCombine' : ConfigEntry({'config' : os.path.join(config_dir, "haloplex.yaml"),
+                                     'cls' : "ratatosk.pipeline.haloplex.HaloPlexCombine"}),
     }
 
+def config_modules(*config_files):
+    """Collect the ratatosk modules referenced by configuration
+    files, i.e. module sections (e.g. ``ratatosk.lib.tools.picard``),
+    parent tasks and handlers.
+
+    :param config_files: configuration file names; None values are ignored
+
+    :returns: sorted list of module names
+    """
+    modules = set()
+    def _add(path):
+        if isinstance(path, str) and path.startswith("ratatosk.") and "." in path:
+            modules.add(path.rsplit(".", 1)[0])
+    def _visit(d):
+        for key, value in d.items():
+            if isinstance(key, str) and key.startswith("ratatosk.") and isinstance(value, dict):
+                modules.add(key)
+            if isinstance(value, dict):
+                _visit(value)
+            elif key in ["parent_task", "target_generator_handler", "target_generator_function"]:
+                for x in (value if isinstance(value, list) else [value]):
+                    _add(x)
+    for cfg in config_files:
+        if not cfg:
+            continue
+        with open(cfg) as fh:
+            config = yaml.load(fh, Loader=Loader)
+        if isinstance(config, dict):
+            _visit(config)
+    return sorted(modules)
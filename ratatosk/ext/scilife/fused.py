@@ -0,0 +1,216 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Fused tasks that replace chains of tasks by programs connected by
+pipes.
+
+:class:`SampeSortSam` runs :program:`bwa sampe`, :program:`samtools
+view` and picard :program:`SortSam` as one pipeline and produces the
+same sorted bam file as the chain
+:class:`ratatosk.lib.align.bwa.Bampe` ->
+:class:`ratatosk.lib.tools.picard.SortSam`, without writing the
+unsorted bam file of :class:`ratatosk.lib.align.bwa.Bampe` to disk
+and reading it back. It is selected per workflow by making it the
+parent task of :class:`ratatosk.lib.tools.picard.MergeSamFiles`. The
+bwa index is not taken from the ``ratatosk.lib.align.bwa`` section
+and must be set in the section of the fused task:
+
+.. code-block:: text
+
+   ratatosk.lib.tools.picard:
+     MergeSamFiles:
+       parent_task: ratatosk.ext.scilife.fused.SampeSortSam
+
+   ratatosk.ext.scilife.fused:
+     SampeSortSam:
+       bwaref: /path/to/bwa/index
+       java_options:
+         - -Xmx4g
+
+Sample runs whose sequence read files are split in chunks can be
+aligned chunk by chunk instead, so that the chunks of a sample run are
+aligned in parallel by the workers of a batch.
+:class:`ChunkSampeSortSam` aligns one chunk, and :class:`MergeChunks`
+merges the chunks of a sample run into the sample run target
+sample_run.sort.bam:
+
+.. code-block:: text
+
+   settings:
+     # Optional; chunks are otherwise found from the fastq file names
+     target_generator_handler: ratatosk.ext.scilife.sample.chunk_target_generator
+
+   ratatosk.lib.tools.picard:
+     MergeSamFiles:
+       parent_task: ratatosk.ext.scilife.fused.MergeChunks
+
+   ratatosk.ext.scilife.fused:
+     ChunkSampeSortSam:
+       bwaref: /path/to/bwa/index
+
+"""
+import os
+import shutil
+import luigi
+import logging
+from ratatosk import backend
+from ratatosk.job import JobTask
+from ratatosk.jobrunner import DefaultShellJobRunner
+from ratatosk.utils import rreplace
+from ratatosk.lib.tools.picard import MergeSamFiles
+from ratatosk.ext.scilife.piperunner import tmp_path, run_pipeline
+from ratatosk.ext.scilife.chunks import chunk_prefix, split_chunk_prefix, run_chunks
+
+logger = logging.getLogger('luigi-interface')
+
+class FusedJobRunner(DefaultShellJobRunner):
+    """Job runner for fused tasks. The task method commands returns
+    the commands of the pipeline given a temporary output file, which
+    is renamed to the task target once all commands have succeeded."""
+    def run_job(self, job):
+        tmp = tmp_path(job.target)
+        commands = job.commands(tmp)
+        logger.info("\nJob runner '{0}';\n\trunning pipeline '{1}'\n".format(self.__class__, " | ".join([" ".join([str(x) for x in cmd]) for cmd in commands])))
+        try:
+            run_pipeline(commands)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        logger.info("renaming {0} to {1}".format(tmp, job.target))
+        os.rename(tmp, job.target)
+
+class SampeSortSam(JobTask):
+    """bwa sampe | samtools view | picard SortSam. The target is named
+    as the output of :class:`ratatosk.lib.tools.picard.SortSam`,
+    e.g. sample_run.sort.bam."""
+    executable = luigi.Parameter(default="bwa")
+    bwaref = luigi.Parameter(default=None)
+    sampe_options = luigi.Parameter(default=(), is_list=True)
+    samtools = luigi.Parameter(default="samtools")
+    # Uncompressed bam is cheaper to pass on than sam or compressed bam
+    samtools_options = luigi.Parameter(default=("-Su",), is_list=True)
+    java_exe = luigi.Parameter(default="java")
+    java_options = luigi.Parameter(default=("-Xmx2g",), is_list=True)
+    picard_home = luigi.Parameter(default=os.getenv("PICARD_HOME") if os.getenv("PICARD_HOME") else os.curdir)
+    options = luigi.Parameter(default=("SO=coordinate MAX_RECORDS_IN_RAM=750000",), is_list=True)
+    add_label = luigi.Parameter(default=("_R1_001", "_R2_001"), is_list=True)
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.Aln", "ratatosk.lib.align.bwa.Aln"), is_list=True)
+    suffix = luigi.Parameter(default=".bam")
+    label = luigi.Parameter(default=".sort")
+    read_group = luigi.Parameter(default=None)
+    platform = luigi.Parameter(default="Illumina")
+    can_multi_thread = False
+    max_memory_gb = 8
+
+    def job_runner(self):
+        return FusedJobRunner()
+
+    def output(self):
+        return luigi.LocalTarget(self.target)
+
+    def _get_read_group(self):
+        """Get the read group passed to bwa sampe. Tabs are escaped
+        since bwa expands them itself."""
+        if self.read_group:
+            return self.read_group
+        rgid = self._read_group_id()
+        # Sample name from the global targets if set, otherwise
+        # from the sample directory name
+        smid = os.path.basename(os.path.dirname(os.path.dirname(rgid)))
+        for tgt in backend.__global_vars__.get("targets", []):
+            if rgid.startswith(tgt.prefix("sample_run")):
+                smid = tgt.sample_id()
+                break
+        return "\\t".join(["@RG", "ID:{}".format(rgid), "SM:{}".format(smid), "PL:{}".format(self.platform)])
+
+    def _read_group_id(self):
+        """Get the read group id, i.e. the sample run prefix"""
+        cls = self.parent()[0]
+        return rreplace(rreplace(self.input()[0].path, cls().sfx(), "", 1), self.add_label[0], "", 1)
+
+    def commands(self, output):
+        """Get the commands of the pipeline.
+
+        :param output: output file name of the last command
+
+        :returns: list of commands, where each command is a list of arguments
+        """
+        if not self.bwaref:
+            raise ValueError("{}: bwaref is not set; set it in the ratatosk.ext.scilife.fused section of the configuration".format(self.__class__.__name__))
+        cls = self.parent()[0]
+        parent_cls = cls().parent()[0]
+        (sai1, sai2) = [x.path for x in self.input()[0:2]]
+        (fastq1, fastq2) = [rreplace(sai, cls().sfx(), parent_cls().sfx(), 1) for sai in (sai1, sai2)]
+        bwa = os.path.join(self.path(), self.exe()) if self.path() else self.exe()
+        sampe = [bwa, "sampe"] + [y for x in self.sampe_options for y in str(x).split()] + \
+            ["-r", self._get_read_group(), self.bwaref, sai1, sai2, fastq1, fastq2]
+        view = [self.samtools, "view"] + [y for x in self.samtools_options for y in str(x).split()] + ["-"]
+        sortsam = [self.java_exe] + list(self.java_options) + ["-jar", os.path.join(self.picard_home, "SortSam.jar"),
+                                                               "INPUT=/dev/stdin", "OUTPUT={}".format(output)] + \
+            [y for x in self.options for y in str(x).split()]
+        return [sampe, view, sortsam]
+
+class ChunkSampeSortSam(SampeSortSam):
+    """:class:`SampeSortSam` for one chunk of a sample run. The target
+    is named as the sample run target with the chunk added, e.g.
+    sample_run.chunk002.sort.bam. The read group is that of the sample
+    run, so that the merged chunks make up one read group."""
+    read_labels = luigi.Parameter(default=("_R1_", "_R2_"), is_list=True)
+
+    def _split_target(self):
+        """Get the sample run prefix and chunk number of the target"""
+        return split_chunk_prefix(rreplace(rreplace(self.target, self.sfx(), "", 1), self.label, "", 1))
+
+    def requires(self):
+        cls = self.parent()[0]
+        (prefix, chunk) = self._split_target()
+        if chunk is None:
+            logger.warn("{} is not a chunk target; expected a name like sample_run.chunk001{}{}".format(self.target, self.label, self.sfx()))
+            return []
+        return [cls(target="{}{}{}{}".format(prefix, x, chunk, cls().sfx())) for x in self.read_labels]
+
+    def _read_group_id(self):
+        return self._split_target()[0]
+
+class MergeChunks(MergeSamFiles):
+    """Merge the chunk alignments of a sample run. The target is the
+    sample run target sample_run.sort.bam, so that the task can
+    replace :class:`SampeSortSam` as parent task of
+    :class:`ratatosk.lib.tools.picard.MergeSamFiles`. The chunks are
+    taken from the chunk-level targets if set, otherwise from the
+    fastq files of the sample run (see
+    :func:`ratatosk.ext.scilife.chunks.run_chunks`). A sample run with
+    a single chunk is hard linked instead of merged."""
+    label = luigi.Parameter(default=".sort")
+    parent_task = luigi.Parameter(default=("ratatosk.ext.scilife.fused.ChunkSampeSortSam",), is_list=True)
+
+    def requires(self):
+        cls = self.parent()[0]
+        prefix = rreplace(rreplace(self.target, self.sfx(), "", 1), self.label, "", 1)
+        chunks = run_chunks(prefix)
+        if not chunks:
+            raise ValueError("{}: no fastq chunks found for sample run {}".format(self.__class__.__name__, prefix))
+        return [cls(target="{}{}{}".format(chunk_prefix(prefix, x), cls().label, cls().sfx())) for x in chunks]
+
+    def run(self):
+        if len(self.input()) > 1:
+            return super(MergeChunks, self).run()
+        # Nothing to merge
+        src = self.input()[0].path
+        logger.info("linking {0} to {1}".format(src, self.target))
+        try:
+            os.link(src, self.target)
+        except OSError:
+            shutil.copy2(src, self.target)
@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Parser for Illumina sequence read file names, e.g.
+
+.. code-block:: text
+
+   P001_101_index3_TGACCA_L001_R1_001.fastq.gz
+
+where the fields are sample name, index (barcode), lane, read and
+chunk number. File names that only comply with the more general
+format ``(.*)_[0-9]+(.fastq|.fastq.gz|.fq|.fq.gz)`` are also accepted,
+in which case only the prefix and chunk number are set.
+
+"""
+import os
+import re
+
+FASTQ_RE = re.compile(r"\.(fastq|fq)(\.gz)?$")
+FASTQ_CHUNK_RE = re.compile(r"(.*)_([0-9]+)(\.f(?:ast)?q(?:\.gz)?)$")
+# Matched against the base name only
+ILLUMINA_RE = re.compile(r"(.*L([0-9]+))_R([12])_([0-9]+)(\.f(?:ast)?q(?:\.gz)?)$")
+
+# Parsed file names. Cleared when it grows beyond _CACHE_SIZE entries.
+_cache = {}
+_CACHE_SIZE = 200000
+
+class FastqFileName(object):
+    """Parsed sequence read file name.
+
+    :ivar path: file path
+    :ivar prefix: sample run prefix, i.e. the path with read, chunk and file suffix removed
+    :ivar sample: sample name, or None
+    :ivar index: index (barcode) sequence, or None
+    :ivar lane: lane number as string, or None
+    :ivar read: read number ('1' or '2'), or None
+    :ivar chunk: chunk number as string
+    :ivar ext: file suffix
+    """
+    __slots__ = ("path", "prefix", "sample", "index", "lane", "read", "chunk", "ext")
+
+    def __init__(self, path, prefix, chunk, ext, sample=None, index=None, lane=None, read=None):
+        self.path = path
+        self.prefix = prefix
+        self.chunk = chunk
+        self.ext = ext
+        self.sample = sample
+        self.index = index
+        self.lane = lane
+        self.read = read
+
+    def __repr__(self):
+        return "FastqFileName('{}')".format(self.path)
+
+def is_fastq(path):
+    """Check if path has a sequence read file suffix.
+
+    :param path: file path
+
+    :returns: True if path is a fastq file, False otherwise
+    """
+    return FASTQ_RE.search(path) is not None
+
+def parse_fastq_filename(path):
+    """Parse a sequence read file name.
+
+    :param path: file path
+
+    :returns: :class:`FastqFileName` object, or None if the file name does not comply with format (.*)_[0-9]+(.fastq|.fastq.gz|.fq|.fq.gz)
+    """
+    rec = _cache.get(path)
+    if rec is not None:
+        return rec
+    i = path.rfind(os.sep) + 1
+    m = ILLUMINA_RE.match(path, i)
+    if m:
+        (name, lane, read, chunk, ext) = m.groups()
+        fields = name.rsplit("_", 2)
+        if len(fields) == 3:
+            rec = FastqFileName(path, path[:i] + name, chunk, ext, fields[0], fields[1], lane, read)
+        else:
+            rec = FastqFileName(path, path[:i] + name, chunk, ext, None, None, lane, read)
+    else:
+        m = FASTQ_CHUNK_RE.match(path)
+        if not m:
+            return None
+        rec = FastqFileName(path, m.group(1), m.group(2), m.group(3))
+    if len(_cache) >= _CACHE_SIZE:
+        _cache.clear()
+    _cache[path] = rec
+    return rec
@@ -0,0 +1,202 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Tracking of submitted cluster jobs.
+
+:class:`JobState` records the job ids and samples of each submitted
+batch in a JSON state file. The state of all jobs is queried in one
+call to :program:`sacct`, falling back to drmaa if :program:`sacct`
+is not available. Array job tasks are identified as
+<array job id>_<task index>, the form used by :program:`sacct`.
+Resubmitted samples are counted in the job they were last submitted
+in.
+
+"""
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+from distutils.spawn import find_executable
+
+SACCT = "sacct"
+ARRAY_TASK_RE = re.compile(r"^([0-9]+)[._]([0-9]+)$")
+ARRAY_RANGE_RE = re.compile(r"^([0-9]+)_\[([0-9,\-]+)(%[0-9]+)?\]$")
+FINISHED = ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "PREEMPTED", "OUT_OF_MEMORY", "BOOT_FAIL", "DEADLINE"]
+
+class JobState(object):
+    """Job state file.
+
+    :param filename: state file name
+    :param project: project (input) directory
+    """
+    def __init__(self, filename, project=None):
+        self.filename = filename
+        self.project = project
+        self.submitted = time.time()
+        self.jobs = []
+
+    def load(self):
+        """Load state file"""
+        with open(self.filename) as fh:
+            data = json.load(fh)
+        self.project = data.get("project", self.project)
+        self.submitted = data.get("submitted", self.submitted)
+        self.jobs = data.get("jobs", [])
+
+    def save(self):
+        """Save state file"""
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({'project' : self.project, 'submitted' : self.submitted, 'jobs' : self.jobs}, fh, indent=1)
+        os.rename(tmp, self.filename)
+
+    def add(self, jobid, jobname, samples, save=True):
+        """Record a submitted job.
+
+        :param jobid: job id
+        :param jobname: job name
+        :param samples: list of sample names in the job
+        :param save: save state file
+        """
+        self.jobs.append({'jobid' : jobid, 'jobname' : jobname, 'samples' : list(samples)})
+        if save:
+            self.save()
+
+    def jobids(self):
+        """Get recorded job ids"""
+        return [x['jobid'] for x in self.jobs]
+
+def normalize_jobid(jobid):
+    """Normalize a job id. Array job tasks reported by drmaa as
+    <array job id>.<task index> are renamed to the sacct form
+    <array job id>_<task index>.
+
+    :param jobid: job id
+
+    :returns: normalized job id
+    """
+    m = ARRAY_TASK_RE.match(jobid)
+    if not m:
+        return jobid
+    return "{}_{}".format(*m.groups())
+
+def expand_jobid(jobid):
+    """Expand a job id reported by sacct. Pending array tasks are
+    reported as ranges, e.g. 1234_[2-4,6%2].
+
+    :param jobid: job id reported by sacct
+
+    :returns: list of job ids
+    """
+    m = ARRAY_RANGE_RE.match(jobid)
+    if not m:
+        return [jobid]
+    jobids = []
+    for x in m.group(2).split(","):
+        if not x:
+            continue
+        (first, last) = (x.split("-") + [x])[0:2]
+        jobids += ["{}_{}".format(m.group(1), i) for i in range(int(first), int(last) + 1)]
+    return jobids
+
+def sacct_states(jobids, sacct=SACCT):
+    """Get the state of jobs in one call to sacct.
+
+    :param jobids: list of job ids
+    :param sacct: sacct executable
+
+    :returns: dictionary mapping normalized job ids to states; jobs unknown to sacct are missing
+    """
+    states = {}
+    if not jobids:
+        return states
+    # Array jobs are queried by array job id, which covers all tasks
+    query = sorted(set([normalize_jobid(x).split("_")[0] for x in jobids]))
+    out = subprocess.Popen([sacct, "-n", "-P", "-X", "-o", "JobID,State", "-j", ",".join(query)], stdout=subprocess.PIPE).communicate()[0]
+    for line in out.decode().splitlines():
+        fields = line.strip().split("|")
+        if len(fields) < 2 or not fields[1]:
+            continue
+        for jobid in expand_jobid(fields[0]):
+            # e.g. 'CANCELLED by 1234'
+            states[jobid] = fields[1].split()[0]
+    return states
+
+def drmaa_states(jobids):
+    """Get the state of jobs via drmaa. Queries each job separately.
+
+    :param jobids: list of job ids
+
+    :returns: dictionary mapping normalized job ids to states
+    """
+    import drmaa
+    names = {drmaa.JobState.QUEUED_ACTIVE : "PENDING", drmaa.JobState.RUNNING : "RUNNING",
+             drmaa.JobState.DONE : "COMPLETED", drmaa.JobState.FAILED : "FAILED"}
+    states = {}
+    s = drmaa.Session()
+    s.initialize()
+    try:
+        for jobid in jobids:
+            try:
+                state = s.jobStatus(jobid)
+            except drmaa.errors.InvalidJobException:
+                continue
+            states[normalize_jobid(jobid)] = names.get(state, str(state).upper())
+    finally:
+        s.exit()
+    return states
+
+def job_states(jobids):
+    """Get the state of jobs, using sacct if available and drmaa
+    otherwise.
+
+    :param jobids: list of job ids
+
+    :returns: dictionary mapping normalized job ids to states
+    """
+    if find_executable(SACCT):
+        return sacct_states(jobids)
+    logging.warn("{} not found; querying job states via drmaa".format(SACCT))
+    return drmaa_states(jobids)
+
+def progress(state, states, now=None):
+    """Summarize progress of the jobs in a state file.
+
+    :param state: :class:`JobState` object
+    :param states: dictionary mapping normalized job ids to states, as returned by :func:`job_states`
+    :param now: current time; defaults to time.time()
+
+    :returns: dictionary with job counts per state and sample counts and throughput
+    """
+    now = now or time.time()
+    counts = {}
+    (done, failed) = (0, 0)
+    seen = set()
+    # Latest submission first, so that resubmitted samples are
+    # counted once
+    for job in reversed(state.jobs):
+        jobstate = states.get(normalize_jobid(job['jobid']), "UNKNOWN")
+        counts[jobstate] = counts.get(jobstate, 0) + 1
+        samples = [x for x in job['samples'] if not x in seen]
+        seen.update(samples)
+        if jobstate == "COMPLETED":
+            done += len(samples)
+        elif jobstate in FINISHED:
+            failed += len(samples)
+    hours = (now - state.submitted) / 3600.0
+    return {'jobs' : counts, 'samples' : len(seen), 'samples_done' : done, 'samples_failed' : failed,
+            'samples_per_hour' : done / hours if hours > 0 else 0.0,
+            'finished' : all(states.get(normalize_jobid(x), None) in FINISHED for x in state.jobids())}
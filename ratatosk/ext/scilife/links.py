@@ -0,0 +1,120 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Bulk linking of raw data to an output directory.
+
+:func:`make_fastq_links` is a replacement for
+:func:`ratatosk.utils.make_fastq_links`. All links are planned up
+front, every output directory is created once, and links are created
+in parallel threads. Links that already point to the right source are
+left untouched, so rerunning on the same output directory is cheap.
+
+"""
+import os
+import glob
+import time
+import errno
+import logging
+from multiprocessing.pool import ThreadPool
+from ratatosk.ext.scilife.chunks import rebase
+
+def plan_fastq_links(targets, indir, outdir, fastq_suffix="001.fastq.gz", ssheet="SampleSheet.csv"):
+    """Plan links from targets (source raw data) to an output
+    directory.
+
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects
+    :param indir: input directory
+    :param outdir: (top) output directory
+    :param fastq_suffix: fastq suffix
+    :param ssheet: sample sheet name
+
+    :returns: tuple (directories, links, newtargets), where directories is a sorted list of directories to create, links a list of (source, link name) tuples and newtargets the targets with updated output directory
+    """
+    dirs = set()
+    links = {}
+    newtargets = []
+    for tgt in targets:
+        # Chunk targets only link the files of their chunk
+        suffix = "{}.fastq.gz".format(tgt.chunk) if getattr(tgt, "chunk", None) is not None else fastq_suffix
+        fastq = glob.glob("{}*{}".format(tgt.prefix("sample_run"), suffix))
+        if len(fastq) == 0:
+            logging.warn("No fastq files for prefix {} in {}".format(tgt.prefix("sample_run"), "make_fastq_links"))
+        for f in fastq:
+            newpath = os.path.join(outdir, os.path.relpath(f, indir))
+            dirs.add(os.path.dirname(newpath))
+            links[newpath] = os.path.abspath(f)
+            src_ssheet = os.path.abspath(os.path.join(os.path.dirname(f), ssheet))
+            if os.path.exists(src_ssheet):
+                links[os.path.join(os.path.dirname(newpath), ssheet)] = src_ssheet
+        newtargets.append(rebase(tgt, indir, outdir))
+    return (sorted(dirs), [(src, dst) for dst, src in sorted(links.items())], newtargets)
+
+def _makedirs(path):
+    """Make directory path; returns True if it was created"""
+    try:
+        os.makedirs(path)
+        return True
+    except OSError as e:
+        if e.errno == errno.EEXIST and os.path.isdir(path):
+            return False
+        raise
+
+def _link(args):
+    """Create symlink dst -> src unless it already exists.
+
+    :returns: one of 'created', 'replaced', 'skipped' or 'failed'
+    """
+    (src, dst) = args
+    try:
+        if os.path.islink(dst):
+            if os.readlink(dst) == src:
+                return "skipped"
+            os.unlink(dst)
+            os.symlink(src, dst)
+            return "replaced"
+        if os.path.exists(dst):
+            return "skipped"
+        os.symlink(src, dst)
+        return "created"
+    except OSError as e:
+        logging.warn("Linking {} -> {} failed: {}".format(dst, src, e))
+        return "failed"
+
+def make_fastq_links(targets, indir, outdir, fastq_suffix="001.fastq.gz", ssheet="SampleSheet.csv", workers=8):
+    """Given a set of targets and an output directory, create links
+    from targets (source raw data) to an output directory.
+
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects
+    :param indir: input directory
+    :param outdir: (top) output directory
+    :param fastq_suffix: fastq suffix
+    :param ssheet: sample sheet name
+    :param workers: number of threads creating links
+
+    :returns: new targets list with updated output directory
+    """
+    t0 = time.time()
+    (dirs, links, newtargets) = plan_fastq_links(targets, indir, outdir, fastq_suffix, ssheet)
+    ndirs = len([d for d in dirs if _makedirs(d)])
+    if workers and workers > 1 and len(links) > 1:
+        pool = ThreadPool(min(workers, len(links)))
+        try:
+            status = pool.map(_link, links)
+        finally:
+            pool.close()
+    else:
+        status = [_link(x) for x in links]
+    counts = dict((x, status.count(x)) for x in ["created", "replaced", "skipped", "failed"])
+    logging.info("Linked {} targets to {}: created {} directories and {created} links, replaced {replaced} and skipped {skipped} existing links, {failed} failed in {elapsed:.2f} seconds".format(len(newtargets), outdir, ndirs, elapsed=time.time() - t0, **counts))
+    return newtargets
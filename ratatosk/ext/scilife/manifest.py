@@ -0,0 +1,89 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Target manifests handed from :program:`ratatosk_submit_job.py` to
+:program:`ratatosk_run_scilife.py`.
+
+A manifest is a JSON file with the sample runs of one batch, as
+resolved by the target generator at submission time. When
+:program:`ratatosk_run_scilife.py` is given a manifest with
+``--targets-manifest``, the sample runs are loaded into
+``backend.__global_vars__["targets"]`` and the scilife target
+generators serve their targets from the manifest instead of scanning
+the input directory.
+
+"""
+import os
+import json
+import logging
+from ratatosk import backend
+from ratatosk.ext.scilife.projectindex import sample_to_dict, sample_from_dict
+
+MANIFEST_VERSION = 1
+
+def write_manifest(filename, targets):
+    """Write sample runs to a manifest file.
+
+    :param filename: manifest file name
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump({'version' : MANIFEST_VERSION, 'targets' : [sample_to_dict(x) for x in targets]}, fh, separators=(",", ":"))
+    os.rename(tmp, filename)
+
+def read_manifest(filename):
+    """Read sample runs from a manifest file.
+
+    :param filename: manifest file name
+
+    :returns: list of :class:`ratatosk.experiment.Sample` objects
+    """
+    with open(filename) as fh:
+        data = json.load(fh)
+    if data.get("version", None) != MANIFEST_VERSION:
+        raise ValueError("unsupported manifest version '{}' in {}".format(data.get("version", None), filename))
+    return [sample_from_dict(x) for x in data['targets']]
+
+def load_manifest(filename):
+    """Read a manifest and use its sample runs as global targets and
+    as the source of the scilife target generators.
+
+    :param filename: manifest file name
+
+    :returns: list of :class:`ratatosk.experiment.Sample` objects
+    """
+    targets = read_manifest(filename)
+    backend.__global_vars__["manifest"] = targets
+    backend.__global_vars__["targets"] = targets
+    return targets
+
+def manifest_targets(indir, target_filter=None):
+    """Get the sample runs of the loaded manifest that belong to a
+    project directory.
+
+    :param indir: project directory
+    :param target_filter: :class:`ratatosk.ext.scilife.targetfilter.TargetFilter`
+
+    :returns: list of :class:`ratatosk.experiment.Sample` objects, or None if no manifest has been loaded or no sample run of the manifest belongs to indir
+    """
+    targets = backend.__global_vars__.get("manifest", None)
+    if targets is None:
+        return None
+    indir = os.path.abspath(indir)
+    targets = [x for x in targets if os.path.abspath(x.prefix("project")) == indir]
+    if not targets:
+        logging.warn("No sample runs of the target manifest belong to {}; scanning the directory".format(indir))
+        return None
+    return [x for x in targets if target_filter is None or target_filter.match_sample_run(x)]
@@ -0,0 +1,64 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Run programs connected by pipes.
+
+Used by fused tasks such as
+:class:`ratatosk.ext.scilife.fused.SampeSortSam`. Unlike
+:class:`ratatosk.jobrunner.PipedJobRunner`, every stage of the
+pipeline is run with its own argument list without a shell, and the
+pipeline fails if any of the stages fails.
+
+"""
+import random
+from subprocess import Popen, PIPE
+
+def tmp_path(path):
+    """Get a temporary file name for an output, named as the
+    temporary files of :class:`ratatosk.jobrunner.DefaultShellJobRunner`.
+
+    :param path: output file name
+
+    :returns: temporary file name
+    """
+    return path + '-luigi-tmp-%09d' % random.randrange(0, 1e10)
+
+def run_pipeline(commands, stdout=None):
+    """Run commands connected by pipes, so that the standard output
+    of each command is the standard input of the next.
+
+    :param commands: list of commands, where each command is a list of arguments
+    :param stdout: file object that receives the standard output of the last command; inherited if None
+
+    :returns: list of return codes
+    """
+    procs = []
+    try:
+        for i, cmd in enumerate(commands):
+            last = i == len(commands) - 1
+            procs.append(Popen([str(x) for x in cmd], stdin=procs[-1].stdout if procs else None,
+                               stdout=stdout if last else PIPE))
+            # Only the next process should hold the read end, so
+            # that the writer gets SIGPIPE if the reader dies
+            if len(procs) > 1:
+                procs[-2].stdout.close()
+    except OSError as e:
+        for p in procs:
+            p.kill()
+            p.wait()
+        raise RuntimeError("Failed to start '{}': {}".format(" ".join([str(x) for x in commands[len(procs)]]), e))
+    returncodes = [p.wait() for p in procs]
+    if any(returncodes):
+        raise RuntimeError("Pipeline '{}' failed with return codes {}".format(" | ".join([" ".join([str(x) for x in cmd]) for cmd in commands]), returncodes))
+    return returncodes
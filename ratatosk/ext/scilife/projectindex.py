@@ -0,0 +1,212 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Persistent on-disk project index used by the scilife target
+generators. The index is an sqlite database that remembers directory
+listings and the sample runs found in each flowcell directory, keyed
+by modification times. Repeated calls to a target generator then only
+re-read directories whose mtime has changed.
+
+The index is stored next to the project directory, e.g.
+``.J.Doe_00_01.ratatosk_index.sqlite`` for project directory
+``J.Doe_00_01``, since writing it inside the project directory would
+change the modification time it is keyed by. Only the process that
+asks for the index (:program:`ratatosk_submit_job.py --index`) writes
+it; target generators that merely find an existing index, such as
+those of batch jobs, open it read-only and fall back to scanning
+directories if it cannot be read.
+
+Sample run prefixes are stored relative to the project directory and
+joined with the project directory as passed by the caller on lookup,
+so that the index can be shared by callers that spell the project
+directory differently, e.g. as relative and absolute paths.
+
+"""
+import os
+import json
+import sqlite3
+import logging
+from ratatosk.experiment import Sample
+from ratatosk.ext.scilife.chunks import ChunkSample
+
+INDEX_FILE = ".ratatosk_index.sqlite"
+# Format of the sample run entries; part of their key so that entries
+# of older formats are reloaded
+INDEX_VERSION = 2
+PREFIXES = ('project_prefix', 'sample_prefix', 'sample_run_prefix')
+
+def index_path(indir, filename=INDEX_FILE):
+    """Get the path of the project index of a project directory.
+
+    :param indir: project directory
+    :param filename: index file name suffix
+
+    :returns: index path, located next to indir
+    """
+    indir = os.path.abspath(indir)
+    return os.path.join(os.path.dirname(indir), ".{}{}".format(os.path.basename(indir), filename))
+
+def sample_to_dict(smp):
+    """Convert a :class:`ratatosk.experiment.Sample` to a dictionary.
+    The chunk number of a
+    :class:`ratatosk.ext.scilife.chunks.ChunkSample` is kept.
+
+    :param smp: sample object
+
+    :returns: dictionary of sample attributes
+    """
+    d = {'project_id' : smp.project_id(),
+         'sample_id' : smp.sample_id(),
+         'project_prefix' : smp.prefix("project"),
+         'sample_prefix' : smp.prefix("sample"),
+         'sample_run_prefix' : smp.prefix("sample_run")}
+    if getattr(smp, "chunk", None) is not None:
+        d['chunk'] = smp.chunk
+    return d
+
+def sample_from_dict(d):
+    """Convert a dictionary generated by :func:`sample_to_dict` back
+    to a :class:`ratatosk.experiment.Sample`.
+
+    :param d: dictionary of sample attributes
+
+    :returns: sample object
+    """
+    kwargs = dict([(k, d[k]) for k in ('project_id', 'sample_id') + PREFIXES])
+    if d.get('chunk', None) is not None:
+        return ChunkSample(chunk=d['chunk'], **kwargs)
+    return Sample(**kwargs)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class ProjectIndex(object):
+    """Project index. Caches subdirectory listings and flowcell
+    sample runs in an sqlite database located next to the project
+    directory.
+
+    Every entry is stored together with a key made up of the
+    modification time(s) it depends on. A lookup compares the stored
+    key with the current one and only calls the loader function on
+    mismatch. Once a lookup fails, e.g. because another process holds
+    a lock on the database, all lookups call the loader function.
+
+    :param indir: project directory
+    :param filename: index file name suffix
+    :param readonly: never write to the index
+    """
+    def __init__(self, indir, filename=INDEX_FILE, readonly=False):
+        self.indir = indir
+        self.path = index_path(indir, filename)
+        self.readonly = readonly
+        self._con = sqlite3.connect(self.path, timeout=5)
+        if not readonly:
+            self._con.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, key TEXT, data TEXT)")
+        self._dirty = False
+        self._failed = False
+
+    def _get(self, path, key, loader):
+        if self._failed:
+            return loader()
+        try:
+            row = self._con.execute("SELECT key, data FROM entries WHERE path = ?", (path, )).fetchone()
+        except sqlite3.Error as e:
+            # Do not wait for the lock again on every lookup
+            logging.warn("Failed to read project index '{}': {}; scanning directories".format(self.path, e))
+            self._failed = True
+            return loader()
+        if row and row[0] == key:
+            return json.loads(row[1])
+        data = loader()
+        if self.readonly:
+            return data
+        try:
+            self._con.execute("INSERT OR REPLACE INTO entries (path, key, data) VALUES (?, ?, ?)", (path, key, json.dumps(data)))
+            self._dirty = True
+        except sqlite3.Error as e:
+            logging.warn("Failed to update project index entry '{}': {}".format(path, e))
+        return data
+
+    def subdirs(self, path):
+        """Get names of subdirectories of path.
+
+        :param path: directory path
+
+        :returns: list of subdirectory names
+        """
+        def _load():
+            return [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
+        return self._get(os.path.abspath(path), repr(_mtime(path)), _load)
+
+    def _relative(self, d):
+        """Make the prefixes of a sample dictionary relative to the
+        project directory"""
+        d = dict(d)
+        for k in PREFIXES:
+            d[k] = os.path.relpath(d[k], self.indir)
+        return d
+
+    def _absolute(self, d):
+        """Join the relative prefixes of a sample dictionary with the
+        project directory"""
+        d = dict(d)
+        for k in PREFIXES:
+            # The project prefix is the project directory itself
+            d[k] = os.path.dirname(os.path.join(self.indir, "")) if d[k] == os.curdir else os.path.join(self.indir, d[k])
+        return d
+
+    def sample_runs(self, fc_dir, loader, depends=()):
+        """Get sample runs for a flowcell directory.
+
+        :param fc_dir: flowcell directory
+        :param loader: function that returns a list of :class:`ratatosk.experiment.Sample` objects
+        :param depends: file names in fc_dir whose mtimes should be part of the key (e.g. sample sheets)
+
+        :returns: list of :class:`ratatosk.experiment.Sample` objects
+        """
+        key = repr([INDEX_VERSION, _mtime(fc_dir)] + [_mtime(os.path.join(fc_dir, x)) for x in depends])
+        data = self._get(os.path.abspath(fc_dir) + os.sep + "#runs", key,
+                         lambda : [self._relative(sample_to_dict(x)) for x in loader()])
+        return [sample_from_dict(self._absolute(x)) for x in data]
+
+    def close(self):
+        """Commit changes and close index"""
+        try:
+            if self._dirty:
+                self._con.commit()
+        except sqlite3.Error as e:
+            logging.warn("Failed to save project index '{}': {}".format(self.path, e))
+        self._con.close()
+
+def open_index(indir, index=None, filename=INDEX_FILE):
+    """Open the project index for indir.
+
+    :param indir: project directory
+    :param index: True to create/update the index, False to disable it, None to use it read-only if it already exists
+    :param filename: index file name suffix
+
+    :returns: :class:`ProjectIndex` or None
+    """
+    if index is False:
+        return None
+    if index is None and not os.path.exists(index_path(indir, filename)):
+        return None
+    try:
+        return ProjectIndex(indir, filename, readonly=index is None)
+    except sqlite3.Error as e:
+        logging.warn("Failed to open project index for '{}': {}; scanning directories".format(indir, e))
+        return None
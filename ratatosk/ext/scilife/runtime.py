@@ -0,0 +1,117 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Runtime history of batches, used to predict the walltime of batches.
+
+:program:`ratatosk_run_scilife.py` records the wall-clock time of
+every successful batch together with the fastq size of the batch, if
+``runtime_history`` is set in the ``settings`` section of the
+configuration:
+
+.. code-block:: text
+
+   settings:
+     runtime_history: /path/to/runtime_history.sqlite
+
+For every workflow, the history gives an average batch time per
+fastq byte. Recording whole batches rather than single tasks means
+that the number of task instances a batch runs (one alignment per
+read and lane, one sort per sample run, and so on) is part of the
+measured time. The predicted walltime of a batch is the time per
+byte times the batch fastq size, multiplied by a safety margin.
+
+"""
+import os
+import time
+import sqlite3
+import logging
+
+HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".ratatosk_runtime.sqlite")
+
+class RuntimeHistory(object):
+    """Runtime history store.
+
+    :param filename: sqlite database file name
+    """
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        self._con = sqlite3.connect(filename, timeout=30)
+        self._con.execute("CREATE TABLE IF NOT EXISTS batches (workflow TEXT, bytes INTEGER, seconds REAL, recorded REAL)")
+
+    def record(self, workflow, nbytes, seconds):
+        """Record the runtime of a batch.
+
+        :param workflow: workflow (main task) name
+        :param nbytes: fastq size of the batch
+        :param seconds: wall-clock time of the batch
+        """
+        with self._con:
+            self._con.execute("INSERT INTO batches (workflow, bytes, seconds, recorded) VALUES (?, ?, ?, ?)",
+                              (workflow, nbytes, seconds, time.time()))
+
+    def seconds_per_byte(self, workflow):
+        """Get the batch time per fastq byte of a workflow.
+
+        :param workflow: workflow name
+
+        :returns: seconds per byte, or None if there is no history for the workflow
+        """
+        (seconds, nbytes) = self._con.execute("SELECT SUM(seconds), SUM(bytes) FROM batches WHERE workflow = ? AND bytes > 0", (workflow, )).fetchone()
+        if not nbytes:
+            return None
+        return seconds / nbytes
+
+    def predict(self, workflow, nbytes, margin=1.5, min_seconds=3600):
+        """Predict the walltime of a batch.
+
+        :param workflow: workflow name
+        :param nbytes: fastq size of the batch
+        :param margin: safety margin multiplied with the predicted time
+        :param min_seconds: minimum walltime
+
+        :returns: walltime in seconds, or None if there is no history for the workflow
+        """
+        rate = self.seconds_per_byte(workflow)
+        if rate is None:
+            return None
+        return max(min_seconds, int(rate * nbytes * margin))
+
+    def close(self):
+        self._con.close()
+
+def format_walltime(seconds):
+    """Format seconds as a time string hh:mm:ss.
+
+    :param seconds: time in seconds
+
+    :returns: time string
+    """
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def record_runtime(filename, workflow, nbytes, seconds):
+    """Record the runtime of a batch in the runtime history, warning
+    instead of failing if the history cannot be written.
+
+    :param filename: runtime history file name
+    :param workflow: workflow (main task) name
+    :param nbytes: fastq size of the batch
+    :param seconds: wall-clock time of the batch
+    """
+    try:
+        history = RuntimeHistory(filename)
+        history.record(workflow, nbytes, seconds)
+        history.close()
+    except sqlite3.Error as e:
+        logging.warn("Failed to record runtime of workflow {} in {}: {}".format(workflow, filename, e))
@@ -16,13 +16,69 @@ import glob
 import csv
 import logging
 import re
+from multiprocessing.pool import ThreadPool
 from ratatosk.utils import rreplace
 from ratatosk.ext.scilife.bcbio import bcbio_config_to_sample_sheet
+from ratatosk.ext.scilife.projectindex import open_index
+from ratatosk.ext.scilife.cache import LRUCache
+from ratatosk.ext.scilife.illumina import is_fastq, parse_fastq_filename
+from ratatosk.ext.scilife.targetfilter import TargetFilter
+from ratatosk.ext.scilife.manifest import manifest_targets
+from ratatosk.ext.scilife.chunks import expand_chunks
 from ratatosk.experiment import ISample, Sample
 from ratatosk import backend
 
+# Use directory entries for directory scanning if available
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 logging.basicConfig(level=logging.DEBUG)
 
+# Lookup tables for backend.__global_vars__["targets"]. They are
+# rebuilt whenever the targets list is replaced or changes length.
+_targets_lookup = {'targets' : None, 'n' : 0, 'sample' : {}}
+
+def targets_lookup():
+    """Get lookup tables for the global targets list in
+    backend.__global_vars__["targets"]. The table 'sample' maps sample
+    ids to sample runs. It is built once per targets list so that task
+    dependency resolution need not scan the entire list for every
+    task.
+
+    :return: dictionary of lookup tables, or None if no global targets have been set
+    """
+    targets = backend.__global_vars__.get("targets", None)
+    if not targets:
+        return None
+    if _targets_lookup['targets'] is not targets or _targets_lookup['n'] != len(targets):
+        by_sample = {}
+        for x in targets:
+            by_sample.setdefault(x.sample_id(), []).append(x)
+        _targets_lookup.update({'targets' : targets, 'n' : len(targets), 'sample' : by_sample})
+    return _targets_lookup
+
+# Memoized generic_target_generator results for
+# generic_collect_sample_runs, keyed by project directory and sample
+_sample_runs_cache = LRUCache(maxsize=4096, ttl=600)
+
+def invalidate_sample_runs_cache(indir=None):
+    """Invalidate memoized sample runs used by
+    :func:`generic_collect_sample_runs`.
+
+    :param indir: project directory to invalidate; if None, invalidate all entries
+    """
+    if indir is None:
+        _sample_runs_cache.invalidate()
+        return
+    for key in _sample_runs_cache.keys():
+        if key[0] == os.path.abspath(indir):
+            _sample_runs_cache.invalidate(key)
+
 def collect_sample_runs(task):
     """Collect sample runs for a sample. Since it is to be used with
     MergeSamFiles it should return a list of targets.
@@ -33,11 +89,13 @@ def collect_sample_runs(task):
     """
     logging.debug("Collecting sample runs for {}".format(task.target))
     sample = os.path.basename(os.path.dirname(task.target))
-    if backend.__global_vars__.get("targets", None):
-        sample_runs = [x for x in backend.__global_vars__.get("targets") if x.sample_id() == sample]
+    lookup = targets_lookup()
+    if lookup:
+        sample_runs = lookup['sample'].get(sample, [])
     else:
-        sample_runs = target_generator_handler(os.path.dirname(os.path.dirname(task.target)), 
-                                               sample=[sample])
+        tgt_fun = backend.__handlers__.get("target_generator_handler", target_generator)
+        sample_runs = tgt_fun(indir=os.path.dirname(os.path.dirname(task.target)),
+                              sample=[sample])
     src_suffix = task.parent()[0]().sfx()
     bam_list = list(set([x.prefix("sample_run") + os.path.basename(rreplace(task.target.replace(x.sample_id(), ""), "{}{}".format(task.label, task.suffix), src_suffix, 1)) for x in sample_runs]))
     logging.debug("Generated target bamfile list {}".format(bam_list))
@@ -52,8 +110,17 @@ def generic_collect_sample_runs(task):
     :return: list of bam files for each sample run in a flowcell directory
     """
     logging.debug("Collecting sample runs for {}".format(task.target))
-    sample_runs = generic_target_generator(os.path.dirname(os.path.dirname(task.target)), 
-                                           sample=[os.path.basename(os.path.dirname(task.target))])
+    sample = os.path.basename(os.path.dirname(task.target))
+    lookup = targets_lookup()
+    if lookup:
+        sample_runs = lookup['sample'].get(sample, [])
+    else:
+        indir = os.path.dirname(os.path.dirname(task.target))
+        key = (os.path.abspath(indir), sample)
+        sample_runs = _sample_runs_cache.get(key)
+        if sample_runs is None:
+            sample_runs = generic_target_generator(indir, sample=[sample])
+            _sample_runs_cache.set(key, sample_runs)
     src_suffix = task.parent()[0]().suffix
     bam_list = list(set([x.prefix("sample_run") + os.path.basename(rreplace(task.target.replace(x.sample_id(), ""), "{}{}".format(task.label, task.suffix), src_suffix, 1)) for x in sample_runs]))
     logging.debug("Generated target bamfile list {}".format(bam_list))
@@ -61,8 +128,10 @@ def generic_collect_sample_runs(task):
 
 def collect_vcf_files(task, sample=None, flowcell=None, lane=None, **kwargs):
     logging.debug("Collecting vcf files for {}".format(task.target))
-    if backend.__global_vars__.get("targets", None):
-        sample_runs = [x for x in backend.__global_vars__.get("targets")]
+    lookup = targets_lookup()
+    if lookup:
+        # One sample run per sample suffices to generate sample targets
+        sample_runs = [x[0] for x in lookup['sample'].values()]
     else:
         sample_runs = target_generator(os.path.dirname(task.target))
     parent_cls = task.parent()[0]
@@ -70,7 +139,7 @@ def collect_vcf_files(task, sample=None, flowcell=None, lane=None, **kwargs):
     logging.debug("Generated target vcffile list {}".format(vcf_list))
     return vcf_list
 
-def generic_target_generator(indir, sample=None, flowcell=None, lane=None, **kwargs):
+def generic_target_generator(indir, sample=None, flowcell=None, lane=None, scan_workers=None, project=None, barcode=None, target_filter=None, chunks=False, **kwargs):
     """Generic target generator. Uses the directory structure only to
     generate target names. Requires SciLife-like directory structure:
 
@@ -92,87 +161,276 @@ def generic_target_generator(indir, sample=None, flowcell=None, lane=None, **kwa
     Traverses input directory, descending two levels (corresponding to
     sample, then flowcell), and finally collects sequence read files
     based on a regular expression.
-    
+
+    Sample directories can be scanned in parallel by a pool of
+    threads, which pays off on network file systems where the
+    latency of each directory listing dominates. The pool size is
+    set by scan_workers, or by the setting
+    ``target_generator_workers`` in the ``settings`` section of the
+    configuration. The order of the returned targets does not depend
+    on the number of workers.
+
+    Sample, flowcell, lane, project and index filters may be glob
+    patterns, and are applied before directories are listed or
+    sample runs created (see :mod:`ratatosk.ext.scilife.targetfilter`).
+    If a target manifest has been loaded (see
+    :mod:`ratatosk.ext.scilife.manifest`), targets are taken from the
+    manifest instead. With chunks, one target is returned per sequence
+    read file chunk of each sample run (see
+    :mod:`ratatosk.ext.scilife.chunks`).
+
     :param indir: input directory
     :param sample: list of sample names to include
     :param flowcell: list of flowcells to include
     :param lane: list of lanes to include
+    :param scan_workers: number of threads used to scan sample directories
+    :param project: list of projects to include
+    :param barcode: list of index sequences to include
+    :param target_filter: :class:`ratatosk.ext.scilife.targetfilter.TargetFilter`; overrides sample, flowcell, lane, project and barcode
+    :param chunks: return :class:`ratatosk.ext.scilife.chunks.ChunkSample` objects, one per chunk
 
     :return: list of :class:`ratatosk.experiment.Sample` objects
     """
     targets = []
+    tf = target_filter or TargetFilter(sample, flowcell, lane, project, barcode)
+    # Serve targets from a loaded manifest without scanning indir
+    manifest = manifest_targets(indir, tf)
+    if manifest is not None:
+        return expand_chunks(manifest) if chunks else manifest
     if not os.path.exists(indir):
         logging.warn("No such input directory '{}'".format(indir))
         return targets
-    samples = os.listdir(indir)
-    # Only run this sample if provided at command line.
-    if sample:
-        samples = sample
-    for s in samples:
-        sampledir = os.path.join(indir, s)
-        if not os.path.isdir(sampledir):
+    # The project is the input directory name
+    if not tf.match_run(project=os.path.basename(os.path.normpath(indir))):
+        return targets
+    samples = tf.samples(lambda : os.listdir(indir))
+    if scan_workers is None:
+        scan_workers = (backend.__global_config__.get("settings", None) or {}).get("target_generator_workers", 1)
+    scan_workers = min(int(scan_workers), len(samples))
+    scan = lambda s: _generic_sample_targets(indir, s, tf)
+    if scan_workers > 1:
+        pool = ThreadPool(scan_workers)
+        try:
+            results = pool.map(scan, samples)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [scan(s) for s in samples]
+    for res in results:
+        targets.extend(res)
+    return expand_chunks(targets) if chunks else targets
+
+def _generic_sample_targets(indir, s, target_filter=None):
+    """Collect sample runs for one sample directory. Helper function
+    for :func:`generic_target_generator`.
+
+    :param indir: input directory
+    :param s: sample name
+    :param target_filter: :class:`ratatosk.ext.scilife.targetfilter.TargetFilter`
+
+    :return: list of :class:`ratatosk.experiment.Sample` objects
+    """
+    targets = []
+    tf = target_filter or TargetFilter()
+    sampledir = os.path.join(indir, s)
+    if not os.path.isdir(sampledir):
+        return targets
+    for fc in tf.flowcells(lambda : _subdirs(sampledir)):
+        fc_dir = os.path.join(sampledir, fc)
+        if not os.path.isdir(fc_dir):
             continue
-        flowcells = [fc for fc in os.listdir(sampledir) if os.path.isdir(os.path.join(sampledir, fc))]
-        for fc in flowcells:
-            if flowcell and not fc in flowcell:
+        fqfiles = [x for x in _list_files(fc_dir) if is_fastq(x)]
+        for fq in fqfiles:
+            fqname = parse_fastq_filename(fq)
+            if not fqname:
+                logging.warn("File {} does not comply with format (.*)_[0-9]+(.fastq$|.fastq.gz$|.fq$|.fq.gz$); skipping".format(fq))
                 continue
-            fc_dir = os.path.join(sampledir, fc)
-            flist = []
-            for root, dirs, files in os.walk(fc_dir):
-                flist = flist + [os.path.join(root, x) for x in files]
-            fqfiles = [x for x in flist if re.match(".*(.fastq$|.fastq.gz$|.fq$|.fq.gz$)", x)]
-            for fq in fqfiles:
-                logging.info("Adding sample '{0}' from flowcell '{1}' to analysis".format(s, fc))
-                m = re.match("(.*)_[0-9]+(.fastq$|.fastq.gz$|.fq$|.fq.gz$)", fq)
-                if not m:
-                    logging.warn("File {} does not comply with format (.*)_[0-9]+(.fastq$|.fastq.gz$|.fq$|.fq.gz$); skipping".format(fq))
-                    continue
-                sample_run_prefix = m.group(1)
-                if re.search("L[0-9]+_R[12]", sample_run_prefix):
-                    sample_run_prefix=os.path.join(fc_dir, os.path.basename(m.group(1).rstrip("R[12]").rstrip("_")))                    
-                smp = Sample(project_id=os.path.basename(os.path.dirname(sampledir)), sample_id = s, sample_prefix=os.path.join(sampledir, s), 
-                             sample_run_prefix = sample_run_prefix,
-                             project_prefix=os.path.dirname(sampledir))
-                targets.append(smp)
+            if not tf.match_run(lane=fqname.lane, barcode=fqname.index):
+                continue
+            logging.info("Adding sample '{0}' from flowcell '{1}' to analysis".format(s, fc))
+            sample_run_prefix = fqname.prefix
+            if fqname.read:
+                sample_run_prefix = os.path.join(fc_dir, os.path.basename(fqname.prefix))
+            smp = Sample(project_id=os.path.basename(os.path.dirname(sampledir)), sample_id = s, sample_prefix=os.path.join(sampledir, s),
+                         sample_run_prefix = sample_run_prefix,
+                         project_prefix=os.path.dirname(sampledir))
+            targets.append(smp)
     return targets
-    
-def target_generator(indir, sample=None, flowcell=None, lane=None, **kwargs):
+
+def _subdirs(path):
+    """List subdirectories of path, using directory entries to avoid
+    an extra stat call per entry where supported.
+
+    :param path: directory path
+
+    :return: list of subdirectory names
+    """
+    if scandir:
+        return [x.name for x in scandir(path) if x.is_dir()]
+    return [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
+
+def _list_files(path):
+    """Recursively list all files below path.
+
+    :param path: directory path
+
+    :return: list of file paths
+    """
+    flist = []
+    if scandir:
+        # Same top-down order as os.walk
+        subdirs = []
+        for x in scandir(path):
+            if x.is_dir():
+                if not x.is_symlink():
+                    subdirs.append(x.path)
+            else:
+                flist.append(x.path)
+        for d in subdirs:
+            flist.extend(_list_files(d))
+        return flist
+    for root, dirs, files in os.walk(path):
+        flist.extend([os.path.join(root, x) for x in files])
+    return flist
+
+def target_generator(indir, sample=None, flowcell=None, lane=None, index=None, project=None, barcode=None, target_filter=None, chunks=False, **kwargs):
     """Target generator function. Collect experimental units based on
     information in SampleSheet.csv or bcbb-config.yaml files.
 
+    If a project index (see :mod:`ratatosk.ext.scilife.projectindex`)
+    exists for indir, directory listings and sample sheets are only
+    re-read for directories whose modification time has changed.
+
+    Sample, flowcell, lane, project and index filters may be glob
+    patterns, and are applied before directories are listed or
+    sample runs created (see :mod:`ratatosk.ext.scilife.targetfilter`).
+    If a target manifest has been loaded (see
+    :mod:`ratatosk.ext.scilife.manifest`), targets are taken from the
+    manifest instead. With chunks, one target is returned per sequence
+    read file chunk of each sample run (see
+    :mod:`ratatosk.ext.scilife.chunks`).
+
     :param indir: input directory
     :param sample: list of sample names to include
     :param flowcell: list of flowcells to include
     :param lane: list of lanes to include
+    :param index: True to create/update the project index, False to disable it, None to use it read-only if it exists
+    :param project: list of projects to include
+    :param barcode: list of index sequences to include
+    :param target_filter: :class:`ratatosk.ext.scilife.targetfilter.TargetFilter`; overrides sample, flowcell, lane, project and barcode
+    :param chunks: return :class:`ratatosk.ext.scilife.chunks.ChunkSample` objects, one per chunk
 
     :return: list of :class:`ratatosk.experiment.Sample` objects
     """
     targets = []
+    tf = target_filter or TargetFilter(sample, flowcell, lane, project, barcode)
+    # Serve targets from a loaded manifest without scanning indir
+    manifest = manifest_targets(indir, tf)
+    if manifest is not None:
+        return expand_chunks(manifest) if chunks else manifest
     if not os.path.exists(indir):
         logging.warn("No such input directory '{}'".format(indir))
         return targets
-    samples = os.listdir(indir)
-    # Only run this sample if provided at command line.
-    if sample:
-        samples = sample
+    idx = open_index(indir, index)
+    samples = tf.samples(lambda : idx.subdirs(indir) if idx else os.listdir(indir))
     for s in samples:
         sampledir = os.path.join(indir, s)
         if not os.path.isdir(sampledir):
             continue
-        flowcells = [fc for fc in os.listdir(sampledir) if fc.endswith("XX")]
+        flowcells = [fc for fc in tf.flowcells(lambda : idx.subdirs(sampledir) if idx else os.listdir(sampledir)) if fc.endswith("XX")]
         for fc in flowcells:
-            if flowcell and not fc in flowcell:
-                continue
             fc_dir = os.path.join(sampledir, fc)
-            ssheet = read_sample_sheet(fc_dir, s, fc)
-            if not ssheet:
+            if not os.path.isdir(fc_dir):
                 continue
-            for line in ssheet:
-                logging.info("Adding sample '{0}' from flowcell '{1}' (barcode '{2}') to analysis".format(s, fc, line['Index']))
-                smp = Sample(project_id=line['SampleProject'].replace("__", "."), sample_id = s,
-                             project_prefix=os.path.dirname(sampledir), sample_prefix=os.path.join(sampledir, s),
-                             sample_run_prefix=os.path.join(fc_dir, "{}_{}_L00{}".format(s, line['Index'], line['Lane'])))
+            if idx:
+                # The index caches all sample runs of a flowcell
+                smplist = idx.sample_runs(fc_dir, lambda : _sample_sheet_targets(fc_dir, sampledir, s, fc), depends=["SampleSheet.csv"])
+                smplist = [x for x in smplist if tf.match_sample_run(x)]
+            else:
+                smplist = _sample_sheet_targets(fc_dir, sampledir, s, fc, tf)
+            for smp in smplist:
+                logging.info("Adding sample '{0}' from flowcell '{1}' (sample run '{2}') to analysis".format(s, fc, os.path.basename(smp.prefix("sample_run"))))
                 targets.append(smp)
+    if idx:
+        idx.close()
+    return expand_chunks(targets) if chunks else targets
+
+def chunk_target_generator(indir, **kwargs):
+    """Chunk-level :func:`target_generator`, for use as
+    target_generator_handler.
+
+    :param indir: input directory
+    :param kwargs: keyword arguments passed on to :func:`target_generator`
+
+    :return: list of :class:`ratatosk.ext.scilife.chunks.ChunkSample` objects
+    """
+    kwargs["chunks"] = True
+    return target_generator(indir, **kwargs)
+
+def generic_chunk_target_generator(indir, **kwargs):
+    """Chunk-level :func:`generic_target_generator`, for use as
+    target_generator_handler.
+
+    :param indir: input directory
+    :param kwargs: keyword arguments passed on to :func:`generic_target_generator`
+
+    :return: list of :class:`ratatosk.ext.scilife.chunks.ChunkSample` objects
+    """
+    kwargs["chunks"] = True
+    return generic_target_generator(indir, **kwargs)
+
+def iter_targets(indir, sample=None, flowcell=None, lane=None, generator=None, **kwargs):
+    """Lazy target generator. Yields sample runs one sample directory
+    at a time, in sorted sample order, so that callers can start
+    processing the first samples while later samples are still being
+    discovered.
+
+    :param indir: input directory
+    :param sample: list of sample names to include
+    :param flowcell: list of flowcells to include
+    :param lane: list of lanes to include
+    :param generator: target generator function called once per sample; defaults to :func:`target_generator`
+    :param kwargs: keyword arguments passed on to generator; a target_filter is restricted to one sample per call
+
+    :return: generator of :class:`ratatosk.experiment.Sample` objects
+    """
+    if generator is None:
+        generator = target_generator
+    if not os.path.exists(indir):
+        logging.warn("No such input directory '{}'".format(indir))
+        return
+    tf = kwargs.pop("target_filter", None)
+    samples = sorted((tf or TargetFilter(sample=sample)).samples(lambda : _subdirs(indir)))
+    for s in samples:
+        if tf:
+            kwargs["target_filter"] = tf.restrict(sample=[s])
+        for smp in generator(indir=indir, sample=[s], flowcell=flowcell, lane=lane, **kwargs):
+            yield smp
+
+def _sample_sheet_targets(fc_dir, sampledir, sample, flowcell, target_filter=None):
+    """Generate sample runs for a flowcell directory from its sample
+    sheet.
+
+    :param fc_dir: flowcell directory
+    :param sampledir: sample directory
+    :param sample: sample name
+    :param flowcell: flowcell name
+    :param target_filter: :class:`ratatosk.ext.scilife.targetfilter.TargetFilter` applied to sample sheet lines
+
+    :return: list of :class:`ratatosk.experiment.Sample` objects
+    """
+    targets = []
+    ssheet = read_sample_sheet(fc_dir, sample, flowcell)
+    if not ssheet:
+        return targets
+    for line in ssheet:
+        if target_filter and not target_filter.match_run(lane=line['Lane'], barcode=line['Index'], project=line['SampleProject'].replace("__", ".")):
+            continue
+        smp = Sample(project_id=line['SampleProject'].replace("__", "."), sample_id = sample,
+                     project_prefix=os.path.dirname(sampledir), sample_prefix=os.path.join(sampledir, sample),
+                     sample_run_prefix=os.path.join(fc_dir, "{}_{}_L00{}".format(sample, line['Index'], line['Lane'])))
+        targets.append(smp)
     return targets
 
 
@@ -189,9 +447,12 @@ def read_sample_sheet(fc_dir, sample=None, flowcell=None, ssheetname="SampleShee
 
     :returns: list of samples, or None
     """
-    if os.path.exists(os.path.join(fc_dir, ssheetname)):
-        fh = file(os.path.join(fc_dir, ssheetname))
-        ssheet = csv.DictReader([x for x in fh if x[0] != "#"])
+    try:
+        st = os.stat(os.path.join(fc_dir, ssheetname))
+    except OSError:
+        st = None
+    if st:
+        ssheet = _read_sample_sheet_file(os.path.join(fc_dir, ssheetname), st)
     else:
         logging.warn("No sample sheet for sample '{}' in flowcell '{}';  trying bcbio format".format(sample, flowcell))
         runinfo = glob.glob(os.path.join(fc_dir, "{}*-bcbb-config.yaml".format(sample)))
@@ -204,3 +465,43 @@ def read_sample_sheet(fc_dir, sample=None, flowcell=None, ssheetname="SampleShee
         else:
             ssheet = bcbio_config_to_sample_sheet(runinfo[0])
     return ssheet
+
+# Parsed sample sheets, keyed by file identity (device, inode,
+# modification time and size). Every entry consists of the header and
+# a list of row tuples.
+_ssheet_cache = LRUCache(maxsize=1024)
+
+def _row_dict(header, row):
+    """Convert a sample sheet row to a dictionary as
+    :class:`csv.DictReader` does: missing columns are set to None and
+    extra values are listed under key None."""
+    d = dict(zip(header, row))
+    if len(row) < len(header):
+        d.update([(k, None) for k in header[len(row):]])
+    elif len(row) > len(header):
+        d[None] = list(row[len(header):])
+    return d
+
+def _read_sample_sheet_file(ssheet, st=None):
+    """Read an Illumina sample sheet. Each sheet is parsed once per
+    process and file version, so that the repeated target generator
+    calls made while resolving task dependencies do not re-read it.
+
+    :param ssheet: sample sheet file name
+    :param st: result of os.stat on ssheet
+
+    :returns: list of dictionaries, one per sample sheet line
+    """
+    if st is None:
+        st = os.stat(ssheet)
+    key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+    parsed = _ssheet_cache.get(key)
+    if parsed is None:
+        with open(ssheet) as fh:
+            reader = csv.reader([x for x in fh if not x.startswith("#")])
+            header = tuple(next(reader, ()))
+            rows = [tuple(x) for x in reader if x]
+        parsed = (header, rows)
+        _ssheet_cache.set(key, parsed)
+    (header, rows) = parsed
+    return [_row_dict(header, x) for x in rows]
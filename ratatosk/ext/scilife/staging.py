@@ -0,0 +1,346 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Staging of batches on node-local scratch.
+
+:program:`ratatosk_run_scilife.py` called with ``--scratch DIR``
+copies the fastq files and sample sheets of its batch to a temporary
+directory in DIR and runs the pipeline there, so that intermediate
+files are never written to the shared project directory. Only the
+final outputs are copied back to the project directory, by a
+background thread as the tasks producing them finish, and every copy
+is verified with an md5 checksum. Final outputs already present in
+the project directory are copied to DIR before the pipeline starts,
+so that a rerun of a failed batch skips the samples that were
+completed. If DIR does not have room for the batch, the pipeline is
+run in place.
+
+Staging is configured in the ``settings`` section of the
+configuration:
+
+.. code-block:: text
+
+   settings:
+     # Suffixes of the outputs to copy back; defaults to the final
+     # target suffix of the workflow
+     stage_outputs:
+       - .sort.merge.bam
+       - .sort.merge.dup.bam
+     # Required free space on scratch, as a multiple of the batch fastq size
+     stage_space_factor: 5
+
+"""
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from ratatosk.ext.scilife.chunks import rebase
+from ratatosk.ext.scilife.batch import fastq_files, fastq_bytes
+
+SPACE_FACTOR = 5
+
+def free_bytes(path):
+    """Get the free space of the file system holding path.
+
+    :param path: file or directory name
+
+    :returns: free space in bytes available to unprivileged users
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def md5sum(filename, blocksize=1 << 20):
+    """Get the md5 checksum of a file.
+
+    :param filename: file name
+    :param blocksize: read block size
+
+    :returns: hex digest
+    """
+    h = hashlib.md5()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda : fh.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def copy_verified(src, dst, retries=1):
+    """Copy a file and verify the copy with an md5 checksum. The copy
+    is written to a temporary file that is renamed to dst once
+    verified.
+
+    :param src: source file name
+    :param dst: destination file name
+    :param retries: number of times a failed copy is retried
+
+    :returns: True if the copy was verified
+    """
+    checksum = md5sum(src)
+    tmp = dst + ".tmp"
+    for i in range(retries + 1):
+        try:
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copy2(src, tmp)
+            if md5sum(tmp) == checksum:
+                os.rename(tmp, dst)
+                return True
+            logging.warn("Checksum of {} differs from {}".format(tmp, src))
+        except (IOError, OSError) as e:
+            logging.warn("Copying {} to {} failed: {}".format(src, dst, e))
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    return False
+
+def plan_staging(targets, indir, stagedir, ssheet="SampleSheet.csv"):
+    """Plan copies of the fastq files and sample sheets of targets to
+    a staging directory, mirroring the project directory structure.
+
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects
+    :param indir: project directory
+    :param stagedir: project directory on scratch
+    :param ssheet: sample sheet name
+
+    :returns: tuple (copies, newtargets), where copies is a list of (source, destination) tuples and newtargets the targets in the staging directory
+    """
+    copies = {}
+    newtargets = []
+    for tgt in targets:
+        for f in fastq_files(tgt):
+            copies[os.path.join(stagedir, os.path.relpath(f, indir))] = f
+            src_ssheet = os.path.join(os.path.dirname(f), ssheet)
+            if os.path.exists(src_ssheet):
+                copies[os.path.join(stagedir, os.path.relpath(src_ssheet, indir))] = src_ssheet
+        newtargets.append(rebase(tgt, indir, stagedir))
+    return ([(src, dst) for dst, src in sorted(copies.items())], newtargets)
+
+def plan_seeding(targets, indir, outdir, stagedir, outputs):
+    """Plan copies of the outputs already present in the output
+    directory to a staging directory, so that the tasks producing
+    them are not run again. Outputs are looked for in the sample and
+    sample run directories of targets.
+
+    :param targets: list of :class:`ratatosk.experiment.Sample` objects in indir
+    :param indir: project directory of targets
+    :param outdir: project directory holding outputs
+    :param stagedir: project directory on scratch
+    :param outputs: tuple of output suffixes
+
+    :returns: list of (source, destination) tuples
+    """
+    dirs = set()
+    for tgt in targets:
+        dirs.add(os.path.relpath(os.path.dirname(tgt.prefix("sample")), indir))
+        dirs.add(os.path.relpath(os.path.dirname(tgt.prefix("sample_run")), indir))
+    copies = []
+    for d in sorted(dirs):
+        if not os.path.isdir(os.path.join(outdir, d)):
+            continue
+        for f in sorted(os.listdir(os.path.join(outdir, d))):
+            src = os.path.join(outdir, d, f)
+            if f.endswith(outputs) and os.path.isfile(src):
+                copies.append((src, os.path.join(stagedir, d, f)))
+    return copies
+
+def _copy_in(args):
+    (src, dst) = args
+    try:
+        shutil.copy2(src, dst)
+        return True
+    except (IOError, OSError) as e:
+        logging.warn("Staging {} to {} failed: {}".format(src, dst, e))
+        return False
+
+class Stager(object):
+    """Stage a batch on scratch and copy its outputs back.
+
+    :param indir: project directory holding the batch inputs
+    :param outdir: project directory outputs are copied back to
+    :param scratch: scratch directory
+    :param outputs: suffixes of outputs to copy back; the batch is run in place if unset
+    :param space_factor: required free space on scratch as a multiple of the batch fastq size
+    :param interval: seconds between checks for finished outputs
+    """
+    def __init__(self, indir, outdir, scratch, outputs=None, space_factor=SPACE_FACTOR, interval=10):
+        self.indir = indir
+        self.outdir = os.path.abspath(outdir)
+        self.scratch = scratch
+        self.outputs = tuple(outputs) if outputs else None
+        self.space_factor = space_factor
+        self.interval = interval
+        self.stagedir = None
+        self.failed = []
+        self._inputs = set()
+        self._copied = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stage(self, targets, workers=4):
+        """Copy the inputs of targets to a new directory on scratch
+        and start the copy-back thread.
+
+        :param targets: list of :class:`ratatosk.experiment.Sample` objects
+        :param workers: number of threads copying inputs
+
+        :returns: targets in the staging directory, or None if the batch does not fit on scratch and should be run in place
+        """
+        if not self.outputs:
+            logging.warn("No outputs to copy back from scratch configured; running in place")
+            return None
+        if not os.path.isdir(self.scratch):
+            logging.warn("No such scratch directory '{}'; running in place".format(self.scratch))
+            return None
+        need = fastq_bytes(targets) * self.space_factor
+        free = free_bytes(self.scratch)
+        if free < need:
+            logging.warn("Scratch directory {} has {} bytes free but batch needs {}; running in place".format(self.scratch, free, need))
+            return None
+        t0 = time.time()
+        self.stagedir = os.path.join(tempfile.mkdtemp(prefix="ratatosk-", dir=self.scratch), os.path.basename(os.path.normpath(self.indir)))
+        (copies, newtargets) = plan_staging(targets, self.indir, self.stagedir)
+        seeds = plan_seeding(targets, self.indir, self.outdir, self.stagedir, self.outputs)
+        if seeds:
+            logging.info("Seeding {} with {} outputs from {}".format(self.stagedir, len(seeds), self.outdir))
+        copies += seeds
+        for d in sorted(set([os.path.dirname(dst) for (src, dst) in copies] + [self.stagedir])):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        if workers and workers > 1 and len(copies) > 1:
+            pool = ThreadPool(min(workers, len(copies)))
+            try:
+                status = pool.map(_copy_in, copies)
+            finally:
+                pool.close()
+        else:
+            status = [_copy_in(x) for x in copies]
+        if not all(status):
+            logging.warn("Staging to {} failed; running in place".format(self.stagedir))
+            self.cleanup()
+            self.stagedir = None
+            return None
+        self._inputs = set([os.path.abspath(dst) for (src, dst) in copies])
+        logging.info("Staged {} files of {} sample runs to {} in {:.2f} seconds".format(len(copies), len(newtargets), self.stagedir, time.time() - t0))
+        self._thread = threading.Thread(target=self._copy_back)
+        self._thread.daemon = True
+        self._thread.start()
+        return newtargets
+
+    def staged_path(self, path):
+        """Get the path in the staging directory of a path in the
+        project directory.
+
+        :param path: path in the project directory
+
+        :returns: path in the staging directory
+        """
+        return os.path.join(self.stagedir, os.path.relpath(path, self.indir))
+
+    @property
+    def done_file(self):
+        """File listing outputs of finished tasks, one per line"""
+        return os.path.join(os.path.dirname(self.stagedir), "outputs.done")
+
+    def add(self, path):
+        """Mark an output as finished. The output is copied back by the
+        copy-back thread if it has one of the configured suffixes.
+        Outputs are passed on through a file so that tasks run in
+        worker processes can mark them.
+
+        :param path: output file name
+        """
+        if self.stagedir is None:
+            return
+        with open(self.done_file, "a") as fh:
+            fh.write(os.path.abspath(path) + "\n")
+
+    def _is_output(self, path):
+        if path in self._inputs or not path.startswith(os.path.abspath(self.stagedir) + os.sep):
+            return False
+        if os.path.islink(path) or not os.path.isfile(path):
+            return False
+        return path.endswith(self.outputs)
+
+    def _copy(self, path):
+        path = os.path.abspath(path)
+        if path in self._copied or not self._is_output(path):
+            return
+        self._copied.add(path)
+        dst = os.path.join(self.outdir, os.path.relpath(path, os.path.abspath(self.stagedir)))
+        if copy_verified(path, dst):
+            logging.info("Copied back {} to {}".format(path, dst))
+        else:
+            self.failed.append(path)
+
+    def _copy_back(self):
+        offset = 0
+        while not self._stop.is_set():
+            self._stop.wait(self.interval)
+            if not os.path.exists(self.done_file):
+                continue
+            with open(self.done_file) as fh:
+                fh.seek(offset)
+                lines = fh.readlines()
+            # Leave a partially written last line for the next round
+            if lines and not lines[-1].endswith("\n"):
+                lines = lines[:-1]
+            offset += sum([len(x) for x in lines])
+            for line in lines:
+                self._copy(line.strip())
+
+    def register_handlers(self):
+        """Register a luigi event handler that marks the outputs of
+        successful tasks as finished, so that they are copied back
+        while the pipeline runs."""
+        import luigi
+        if not hasattr(luigi, "Event"):
+            logging.warn("luigi version has no task events; copying back outputs when the pipeline has finished")
+            return
+        from luigi.task import flatten
+
+        @luigi.Task.event_handler(luigi.Event.SUCCESS)
+        def _success(task):
+            for out in flatten(task.output()):
+                if getattr(out, "path", None):
+                    self.add(out.path)
+
+    def finish(self, cleanup=True):
+        """Wait for the copy-back thread, copy back the remaining
+        outputs and remove the staging directory if all copies
+        succeeded.
+
+        :param cleanup: remove the staging directory; set to False to keep the intermediate files of a failed run
+
+        :returns: list of outputs that could not be copied back
+        """
+        if self.stagedir is None:
+            return []
+        self._stop.set()
+        self._thread.join()
+        for root, dirs, files in os.walk(self.stagedir):
+            for f in sorted(files):
+                self._copy(os.path.join(root, f))
+        if self.failed:
+            logging.warn("Failed to copy back {} outputs; leaving {} in place".format(len(self.failed), self.stagedir))
+        elif cleanup:
+            self.cleanup()
+        else:
+            logging.warn("Leaving staging directory {} in place".format(self.stagedir))
+        return self.failed
+
+    def cleanup(self):
+        """Remove the staging directory"""
+        shutil.rmtree(os.path.dirname(self.stagedir), ignore_errors=True)
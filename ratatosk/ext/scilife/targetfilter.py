@@ -0,0 +1,150 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Filter on sample runs used by the target generators.
+
+A :class:`TargetFilter` holds lists of glob patterns for sample,
+flowcell, lane, project and index (barcode) sequence. The target
+generators apply it as early as possible: literal sample and
+flowcell names are used directly instead of listing directories,
+and sample sheet lines and fastq files are filtered on lane, index
+and project before any sample runs are created.
+
+"""
+import os
+import re
+import fnmatch
+
+GLOB_CHARS = re.compile(r"[*?[]")
+# Sample run prefix, e.g. P001_101_index3_TGACCA_L001
+SAMPLE_RUN_RE = re.compile(r"_([^_]+)_L0*([0-9]+)$")
+
+def _lane(x):
+    """Normalize lane number, e.g. 1, '1' and '001' all become '1'"""
+    x = str(x)
+    return str(int(x)) if x.isdigit() else x
+
+class _Patterns(object):
+    """List of glob patterns. Matches everything if empty."""
+    def __init__(self, patterns=None, normalize=str):
+        self.normalize = normalize
+        self.patterns = [normalize(x) for x in patterns] if patterns else []
+        self._literal = not any(GLOB_CHARS.search(x) for x in self.patterns)
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+    __nonzero__ = __bool__
+
+    def match(self, value):
+        if not self.patterns:
+            return True
+        if value is None:
+            return False
+        value = self.normalize(value)
+        if self._literal:
+            return value in self.patterns
+        return any(fnmatch.fnmatchcase(value, x) for x in self.patterns)
+
+    def literal(self):
+        """Get patterns if all of them are literal names, otherwise
+        None"""
+        if self.patterns and self._literal:
+            return list(self.patterns)
+        return None
+
+class TargetFilter(object):
+    """Filter on sample runs. Every argument is a list of names or
+    glob patterns; None matches everything.
+
+    :param sample: sample names
+    :param flowcell: flowcell names
+    :param lane: lane numbers
+    :param project: project names
+    :param barcode: index (barcode) sequences
+    """
+    def __init__(self, sample=None, flowcell=None, lane=None, project=None, barcode=None):
+        self._args = {'sample' : sample, 'flowcell' : flowcell, 'lane' : lane, 'project' : project, 'barcode' : barcode}
+        self.sample = _Patterns(sample)
+        self.flowcell = _Patterns(flowcell)
+        self.lane = _Patterns(lane, _lane)
+        self.project = _Patterns(project)
+        self.barcode = _Patterns(barcode)
+
+    def restrict(self, **kwargs):
+        """Get a copy of the filter with some patterns replaced, e.g.
+        restrict(sample=["P001_101_index3"]).
+
+        :returns: :class:`TargetFilter`
+        """
+        args = dict(self._args)
+        args.update(kwargs)
+        return TargetFilter(**args)
+
+    def samples(self, listdir):
+        """Get the sample names to scan.
+
+        :param listdir: function returning the names in the input directory; only called if the sample filter contains glob patterns or is empty
+
+        :returns: list of sample names
+        """
+        names = self.sample.literal()
+        if names is not None:
+            return names
+        return [x for x in listdir() if self.sample.match(x)]
+
+    def flowcells(self, listdir):
+        """Get the flowcell names to scan.
+
+        :param listdir: function returning the names in the sample directory; only called if the flowcell filter contains glob patterns or is empty
+
+        :returns: list of flowcell names
+        """
+        names = self.flowcell.literal()
+        if names is not None:
+            return names
+        return [x for x in listdir() if self.flowcell.match(x)]
+
+    def match_run(self, lane=None, barcode=None, project=None):
+        """Check sample run attributes. Attributes that are None are
+        not checked.
+
+        :param lane: lane number
+        :param barcode: index sequence
+        :param project: project name
+
+        :returns: True if the sample run passes the filter
+        """
+        if self.lane and lane is not None and not self.lane.match(lane):
+            return False
+        if self.barcode and barcode is not None and not self.barcode.match(barcode):
+            return False
+        if self.project and project is not None and not self.project.match(project):
+            return False
+        return True
+
+    def match_sample_run(self, smp):
+        """Check a :class:`ratatosk.experiment.Sample` object, taking
+        lane and index sequence from the sample run prefix.
+
+        :param smp: sample run
+
+        :returns: True if the sample run passes the filter
+        """
+        if not self.sample.match(smp.sample_id()):
+            return False
+        if not self.flowcell.match(os.path.basename(os.path.dirname(smp.prefix("sample_run")))):
+            return False
+        m = SAMPLE_RUN_RE.search(os.path.basename(smp.prefix("sample_run")))
+        (barcode, lane) = m.groups() if m else (None, None)
+        return self.match_run(lane, barcode, smp.project_id())
@@ -0,0 +1,125 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Per-task resource usage traces.
+
+:func:`register_trace_handlers` registers luigi event handlers that
+append one JSON line per finished task to a trace file, with start
+and end time, CPU time and peak resident set size of child processes
+(i.e. the programs the task ran), and bytes read and written.
+
+Traces of several batches can be summarized per task with
+
+.. code-block:: text
+
+   python -m ratatosk.ext.scilife.trace *-trace.jsonl
+
+"""
+import os
+import sys
+import json
+import time
+import logging
+import resource
+
+def _io_bytes():
+    """Get bytes read and written by this process and its reaped
+    children from /proc/self/io. Returns (None, None) if not
+    available."""
+    try:
+        with open("/proc/self/io") as fh:
+            io = dict(line.split(":") for line in fh if ":" in line)
+        return (int(io["read_bytes"]), int(io["write_bytes"]))
+    except (IOError, OSError, KeyError, ValueError):
+        return (None, None)
+
+def _diff(a, b):
+    return b - a if a is not None and b is not None else None
+
+def register_trace_handlers(filename):
+    """Register luigi event handlers that write a JSON-lines trace of
+    all tasks run by this process and its workers.
+
+    CPU time and bytes read/written are differences between task
+    start and end, and include all child processes that finished in
+    between. Peak RSS is the largest resident set size of any child
+    process so far, in kilobytes.
+
+    :param filename: trace file name; lines are appended
+    """
+    import luigi
+    if not hasattr(luigi, "Event"):
+        logging.warn("luigi version has no task events; not writing trace {}".format(filename))
+        return
+    start = {}
+
+    @luigi.Task.event_handler(luigi.Event.START)
+    def _start(task):
+        start[task.task_id] = (time.time(), resource.getrusage(resource.RUSAGE_CHILDREN), _io_bytes())
+
+    def _finish(task, status):
+        if not task.task_id in start:
+            return
+        (t0, ru0, io0) = start.pop(task.task_id)
+        t1 = time.time()
+        ru1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io1 = _io_bytes()
+        rec = {'task' : task.task_family, 'task_id' : task.task_id, 'status' : status, 'pid' : os.getpid(),
+               'start' : t0, 'end' : t1, 'seconds' : t1 - t0,
+               'cpu_user' : ru1.ru_utime - ru0.ru_utime, 'cpu_system' : ru1.ru_stime - ru0.ru_stime,
+               'maxrss_kb' : ru1.ru_maxrss,
+               'read_bytes' : _diff(io0[0], io1[0]), 'write_bytes' : _diff(io0[1], io1[1])}
+        try:
+            # One write per line so that lines from concurrent workers do not interleave
+            with open(filename, "a") as fh:
+                fh.write(json.dumps(rec, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            logging.warn("Failed to write trace of task {} to {}: {}".format(task.task_id, filename, e))
+
+    @luigi.Task.event_handler(luigi.Event.SUCCESS)
+    def _success(task):
+        _finish(task, "success")
+
+    @luigi.Task.event_handler(luigi.Event.FAILURE)
+    def _failure(task, exception):
+        _finish(task, "failure")
+
+def summarize_traces(filenames):
+    """Summarize traces per task.
+
+    :param filenames: list of trace file names
+
+    :returns: list of dictionaries with keys task, n, seconds, cpu, maxrss_kb, read_bytes and write_bytes, sorted by decreasing total seconds
+    """
+    summary = {}
+    for fn in filenames:
+        with open(fn) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                s = summary.setdefault(rec['task'], {'task' : rec['task'], 'n' : 0, 'seconds' : 0.0, 'cpu' : 0.0,
+                                                     'maxrss_kb' : 0, 'read_bytes' : 0, 'write_bytes' : 0})
+                s['n'] += 1
+                s['seconds'] += rec['seconds']
+                s['cpu'] += rec['cpu_user'] + rec['cpu_system']
+                s['maxrss_kb'] = max(s['maxrss_kb'], rec['maxrss_kb'])
+                s['read_bytes'] += rec['read_bytes'] or 0
+                s['write_bytes'] += rec['write_bytes'] or 0
+    return sorted(summary.values(), key=lambda x:-x['seconds'])
+
+if __name__ == "__main__":
+    sys.stdout.write("{:<30} {:>6} {:>12} {:>12} {:>12} {:>16} {:>16}\n".format("task", "n", "seconds", "cpu", "maxrss_kb", "read_bytes", "write_bytes"))
+    for s in summarize_traces(sys.argv[1:]):
+        sys.stdout.write("{task:<30} {n:>6} {seconds:>12.1f} {cpu:>12.1f} {maxrss_kb:>12} {read_bytes:>16} {write_bytes:>16}\n".format(**s))
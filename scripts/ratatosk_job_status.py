@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+import os
+import sys
+import time
+import argparse
+import logging
+from ratatosk.ext.scilife.jobstate import JobState, job_states, progress
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report progress of jobs submitted with ratatosk_submit_job.py.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--interval', type=int, default=300,
+                        help='polling interval in seconds')
+    parser.add_argument('--once', action="store_true", default=False,
+                        help='report status once and exit')
+    parser.add_argument('state_file', type=str, nargs="+",
+                        help='job state file(s) written by ratatosk_submit_job.py')
+    pargs = parser.parse_args()
+
+    states = []
+    for fn in pargs.state_file:
+        if not os.path.exists(fn):
+            logging.warn("No such state file '{}'".format(fn))
+            continue
+        state = JobState(fn)
+        state.load()
+        states.append(state)
+    if not states:
+        sys.exit(1)
+
+    while True:
+        # One query for the jobs of all state files
+        current = job_states(sum([x.jobids() for x in states], []))
+        finished = True
+        for state in states:
+            p = progress(state, current)
+            finished = finished and p['finished']
+            logging.info("{}: {}/{} samples done, {} failed, {:.1f} samples/hour; jobs: {}".format(
+                    state.project, p['samples_done'], p['samples'], p['samples_failed'], p['samples_per_hour'],
+                    ", ".join(["{} {}".format(v, k) for k, v in sorted(p['jobs'].items())])))
+        if finished or pargs.once:
+            break
+        time.sleep(pargs.interval)
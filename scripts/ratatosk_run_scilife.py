@@ -16,21 +16,176 @@
 import luigi
 import os
 import sys
+import time
+import signal
+import logging
 from ratatosk.config import setup_config
 from ratatosk.handler import setup_global_handlers
-import ratatosk.lib.align.bwa
-import ratatosk.lib.tools.gatk
-import ratatosk.lib.tools.samtools
-import ratatosk.lib.tools.picard
-import ratatosk.lib.annotation.annovar
-import ratatosk.lib.utils.cutadapt
-from ratatosk.pipeline.haloplex import HaloPlex, HaloPlexSummary, HaloPlexCombine
-from ratatosk.pipeline.seqcap import SeqCap, SeqCapSummary
-from ratatosk.pipeline.align import Align, AlignSummary
-from ratatosk.report.sphinx import SphinxReport
-from ratatosk.ext.scilife.config import config_dict
+from ratatosk import backend
+from ratatosk.ext.scilife.config import config_dict, config_modules
+
+# Modules imported when running an arbitrary task, so that all tasks
+# are registered with luigi
+TASK_MODULES = [
+    "ratatosk.lib.align.bwa",
+    "ratatosk.lib.tools.gatk",
+    "ratatosk.lib.tools.samtools",
+    "ratatosk.lib.tools.picard",
+    "ratatosk.lib.annotation.annovar",
+    "ratatosk.lib.utils.cutadapt",
+    "ratatosk.pipeline.haloplex",
+    "ratatosk.pipeline.seqcap",
+    "ratatosk.pipeline.align",
+    "ratatosk.report.sphinx",
+    ]
+
+def import_modules(modules, required=True):
+    """Import task modules.
+
+    :param modules: list of module names
+    :param required: raise ImportError if a module fails to load; otherwise only warn
+    """
+    for mod in modules:
+        try:
+            __import__(mod)
+        except ImportError as e:
+            if required:
+                raise
+            logging.warn("Failed to import module '{}': {}".format(mod, e))
+
+def _option_values(args, option):
+    """Get all values of option in argument list args"""
+    return [args[i+1] for i, x in enumerate(args[:-1]) if x == option]
+
+def pop_option(args, option):
+    """Remove option and its value from argument list args.
+
+    :returns: option value, or None if option is not in args
+    """
+    if not option in args[:-1]:
+        return None
+    i = args.index(option)
+    value = args[i+1]
+    del args[i:i+2]
+    return value
+
+def batch_indir(task_args):
+    """Get the project directory of the batch selected by task_args"""
+    targets = _option_values(task_args, "--generic-wrapper-target")
+    indir = _option_values(task_args, "--indir") or [os.path.dirname(os.path.dirname(x)) for x in targets]
+    return indir[0] if indir else None
+
+def batch_targets(task_args):
+    """Get the sample runs of the batch selected by task_args"""
+    from ratatosk.ext.scilife.sample import target_generator
+    if backend.__global_vars__.get("manifest", None) is not None:
+        return backend.__global_vars__["manifest"]
+    targets = _option_values(task_args, "--generic-wrapper-target")
+    samples = _option_values(task_args, "--sample") or [os.path.basename(os.path.dirname(x)) for x in targets]
+    indir = batch_indir(task_args)
+    if not indir:
+        return []
+    tgt_fun = backend.__handlers__.get("target_generator_handler", target_generator)
+    return tgt_fun(indir=indir, sample=samples or None,
+                   flowcell=_option_values(task_args, "--flowcell") or None,
+                   lane=_option_values(task_args, "--lane") or None)
+
+def batch_fastq_bytes(task_args):
+    """Get the total fastq size of the samples selected by task_args"""
+    from ratatosk.ext.scilife.batch import fastq_bytes
+    return fastq_bytes(batch_targets(task_args))
+
+def final_suffixes(task_cls, task_args):
+    """Get the suffixes of the final targets of a workflow, i.e. the
+    final target suffix of a pipeline task, or the suffixes of the
+    targets given with --generic-wrapper-target.
+
+    :param task_cls: pipeline task class, or None
+    :param task_args: task arguments
+
+    :returns: list of suffixes, empty if they cannot be determined
+    """
+    if task_cls and getattr(task_cls, "final_target_suffix", None):
+        return [task_cls.final_target_suffix]
+    # Generic wrapper targets are named sample_prefix + suffix
+    return sorted(set([os.path.basename(x)[len(os.path.basename(os.path.dirname(x))):] for x in _option_values(task_args, "--generic-wrapper-target")]))
+
+def final_targets(task_cls, task_args):
+    """Get the final targets of the batch selected by task_args, i.e.
+    the final target of every sample in the output directory for a
+    pipeline task, or the targets given with
+    --generic-wrapper-target.
+
+    :param task_cls: pipeline task class, or None
+    :param task_args: task arguments
+
+    :returns: list of target file names, empty if they cannot be determined
+    """
+    if not (task_cls and getattr(task_cls, "final_target_suffix", None)):
+        return _option_values(task_args, "--generic-wrapper-target")
+    from ratatosk.ext.scilife.batch import final_target
+    from ratatosk.ext.scilife.chunks import rebase
+    indir = batch_indir(task_args)
+    outdir = (_option_values(task_args, "--outdir") or [indir])[0]
+    samples = {}
+    for smp in batch_targets(task_args):
+        samples.setdefault(smp.sample_id(), []).append(rebase(smp, indir, outdir))
+    return [final_target(v, task_cls.final_target_suffix) for v in samples.values()]
+
+def ran_batch(success, pending):
+    """Tell whether a batch ran and completed work, so that its run
+    time can be recorded.
+
+    :param success: return value of luigi.run; None for luigi versions that do not report success
+    :param pending: final targets missing before the run
+
+    :returns: True if the batch completed pending targets
+    """
+    if success is False or not pending:
+        return False
+    # Without a result from luigi, the pending targets must now exist
+    return success is True or all(os.path.exists(x) for x in pending)
+
+def stage_batch(task_args, scratch, settings, task_cls=None):
+    """Stage the batch selected by task_args on scratch. On success,
+    the staged sample runs are used as target manifest and the
+    directory options of task_args are rewritten to point to the
+    staging directory.
+
+    :param task_args: task arguments; modified in place
+    :param scratch: scratch directory
+    :param settings: settings section of the configuration
+    :param task_cls: pipeline task class, used for the default outputs to copy back
+
+    :returns: :class:`ratatosk.ext.scilife.staging.Stager` instance, or None if the batch is run in place
+    """
+    from ratatosk.ext.scilife.staging import Stager, SPACE_FACTOR
+    indir = batch_indir(task_args)
+    if not indir:
+        logging.warn("Could not determine the input directory of the batch; running in place")
+        return None
+    outdir = (_option_values(task_args, "--outdir") or [indir])[0]
+    outputs = settings.get("stage_outputs", None) or final_suffixes(task_cls, task_args)
+    stager = Stager(indir, outdir, scratch, outputs=outputs,
+                    space_factor=settings.get("stage_space_factor", SPACE_FACTOR))
+    staged = stager.stage(batch_targets(task_args))
+    if staged is None:
+        return None
+    backend.__global_vars__["manifest"] = staged
+    backend.__global_vars__["targets"] = staged
+    for i, x in enumerate(task_args[:-1]):
+        if x in ("--indir", "--outdir"):
+            task_args[i+1] = stager.stagedir
+        elif x == "--generic-wrapper-target":
+            task_args[i+1] = stager.staged_path(task_args[i+1])
+    stager.register_handlers()
+    return stager
 
 if __name__ == "__main__":
+    # Options handled here and not passed on to luigi
+    trace_file = pop_option(sys.argv, "--trace")
+    targets_manifest = pop_option(sys.argv, "--targets-manifest")
+    scratch = pop_option(sys.argv, "--scratch")
     task_cls = None
     if len(sys.argv) > 1:
         task = sys.argv[1]
@@ -54,11 +209,63 @@ if __name__ == "__main__":
     if "--custom-config" in task_args:
         custom_config_file = task_args[task_args.index("--custom-config") + 1]
 
+    # Predefined workflows only need the modules referenced by their
+    # configuration files, which must all load; otherwise load the
+    # task modules that are available
+    if task_cls:
+        import_modules(config_modules(config_file, custom_config_file))
+    else:
+        import_modules(TASK_MODULES, required=False)
+
     setup_config(config_file=config_file, custom_config_file=custom_config_file)
     setup_global_handlers()
+    # Sample runs resolved by ratatosk_submit_job.py; the target
+    # generators serve from these instead of scanning the input directory
+    if targets_manifest:
+        from ratatosk.ext.scilife.manifest import load_manifest
+        logging.info("loaded {} sample runs from target manifest {}".format(len(load_manifest(targets_manifest)), targets_manifest))
 
-    if task_cls:
-        luigi.run(task_args, main_task_cls=task_cls)
-    # Whatever other task/config the user wants to run
-    else:
-        luigi.run()
+    # Record the batch runtime for walltime prediction in
+    # ratatosk_submit_job.py. The batch size and the missing final
+    # targets are determined once here, before staging rewrites the
+    # batch arguments.
+    settings = backend.__global_config__.get("settings", None) or {}
+    runtime_history = settings.get("runtime_history", None) if task else None
+    if runtime_history:
+        workflow = (_option_values(task_args, "--task") or [task])[0] if task == "GenericWrapper" else task
+        nbytes = batch_fastq_bytes(task_args)
+        pending = [x for x in final_targets(task_cls, task_args) if not os.path.exists(x)]
+    # Per-task resource usage trace
+    if trace_file:
+        from ratatosk.ext.scilife.trace import register_trace_handlers
+        register_trace_handlers(trace_file)
+
+    # Run the batch on node-local scratch
+    stager = None
+    if task and scratch:
+        stager = stage_batch(task_args, scratch, settings, task_cls)
+        if stager:
+            # Turn a kill by the scheduler into an exception, so that
+            # finished outputs are copied back below
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    t0 = time.time()
+    success = False
+    try:
+        if task_cls:
+            success = luigi.run(task_args, main_task_cls=task_cls)
+        # Whatever other task/config the user wants to run
+        else:
+            success = luigi.run([task] + task_args if stager else None)
+    finally:
+        # luigi versions that do not report success return None.
+        # Failed runs keep the staging directory with their
+        # intermediate files; finished outputs are copied back either way
+        failed = stager.finish(cleanup=success is not False) if stager else []
+    if stager and (failed or success is False):
+        sys.exit(1)
+    # Batches with nothing to do or an unknown result would record
+    # a misleading run time
+    if runtime_history and ran_batch(success, pending):
+        from ratatosk.ext.scilife.runtime import record_runtime
+        record_runtime(runtime_history, workflow, nbytes, time.time() - t0)
@@ -20,11 +20,17 @@ import sys
 import argparse
 import itertools
 import logging
-import copy
 import yaml
 from ratatosk.handler import RatatoskHandler, _load
-from ratatosk.ext.scilife.sample import target_generator
-from ratatosk.utils import make_fastq_links, opt_to_dict
+from ratatosk.ext.scilife.sample import target_generator, iter_targets
+from ratatosk.ext.scilife.cluster import DrmaaSubmitter
+from ratatosk.ext.scilife.batch import PACK_BY, sample_weight, pack_batches, batch_load_report, final_target, incomplete_samples, fastq_bytes
+from ratatosk.ext.scilife.runtime import RuntimeHistory, HISTORY_FILE, format_walltime
+from ratatosk.ext.scilife.links import make_fastq_links
+from ratatosk.ext.scilife.jobstate import JobState
+from ratatosk.ext.scilife.manifest import write_manifest
+from ratatosk.ext.scilife.chunks import rebase
+from ratatosk.utils import opt_to_dict
 
 logging.basicConfig(level=logging.INFO)
 
@@ -38,6 +44,13 @@ except:
 # Called script
 RATATOSK_RUN = "ratatosk_run_scilife.py"
 RATATOSKD = "ratatoskd"
+# Port of the ratatoskd api; ratatoskd has no option to change it,
+# and it is the default port of the luigi workers
+RATATOSKD_PORT = 8082
+# Readiness probe for ratatoskd run on compute nodes
+WAIT_FOR_SCHEDULER = ["python", "-m", "ratatosk.ext.scilife.cluster"]
+# Environment variable holding the array task index on the nodes
+ARRAY_TASK_ID = "SLURM_ARRAY_TASK_ID"
 
 ## yes or no: http://stackoverflow.com/questions/3041986/python-command-line-yes-no-input
 def query_yes_no(question, default="yes", force=False):
@@ -81,52 +94,23 @@ def query_yes_no(question, default="yes", force=False):
             sys.stdout.write("Please respond with 'yes' or 'no' "\
                                  "(or 'y' or 'n').\n")
 
-def dry(message, func, dry_run=True, *args, **kw):
-    """Wrapper that runs a function (runpipe) if flag dry_run isn't set, otherwise returns function call as string
-    
-    :param message: message describing function call
-    :param func: function to call
-    :param *args: positional arguments to pass to function
-    :param **kw: keyword arguments to pass to function
+def drmaa_wrapper(cmd_args, pargs, submitter, state=None, sample_batch=None, walltime=None):
+    """Submit a batch command.
+
+    :param cmd_args: list of commands, where each command is a list of arguments
+    :param pargs: program arguments
+    :param submitter: :class:`ratatosk.ext.scilife.cluster.DrmaaSubmitter` instance
+    :param state: :class:`ratatosk.ext.scilife.jobstate.JobState` instance in which the job is recorded
+    :param sample_batch: list of sample names in batch
+    :param walltime: time limit formatted as hh:mm:ss; defaults to --time
+
+    :returns: job id, or None if dry run
     """
-    if dry_run:
-        logging.info("(DRY_RUN): " + str(message) + "\n")
-        return "(DRY_RUN): " + str(message) + "\n"
-    return func(*args, **kw)
-
-def drmaa_wrapper(cmd_args, pargs, capture=True, ignore_error=False, cwd=None):
-    kw = vars(pargs)
-    job_args = make_job_template_args(opt_to_dict(pargs.extra), **kw)
     command = "\n".join([" ".join(x) for x in cmd_args])
-    def runpipe():
-        s = drmaa.Session()
-        s.initialize()
-        jt = s.createJobTemplate()
-        jt.remoteCommand = command
-        jt.jobName = job_args['jobname']
-
-        if os.path.isdir(job_args['outputPath']):
-            jt.outputPath = ":" + drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.join(os.path.relpath(job_args['outputPath'], os.getenv("HOME")), jt.jobName + "-drmaa.log")
-        else:
-            jt.outputPath = ":" + drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.join(os.path.relpath(job_args['outputPath'], os.getenv("HOME")))
-        if os.path.isdir(job_args['errorPath']):
-            jt.errorPath = ":" + drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.join(os.path.relpath(job_args['errorPath'], os.getenv("HOME")), jt.jobName + "-drmaa.err")
-        else:
-            jt.errorPath = ":" + drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.join(os.path.relpath(job_args['errorPath'], os.getenv("HOME")))
-
-        jt.workingDirectory = drmaa.JobTemplate.HOME_DIRECTORY + os.sep + os.path.relpath(job_args['workingDirectory'], os.getenv("HOME"))
-        jt.nativeSpecification = "-t {time} -p {partition} -A {account} {extra}".format(**job_args)
-        if kw.get('email', None):
-            jt.email=[kw.get('email')]
-        logging.info("Submitting job with native specification {}".format(jt.nativeSpecification))
-        logging.info("Working directory: {}".format(jt.workingDirectory))
-        logging.info("Output logging: {}".format(jt.outputPath))
-        logging.info("Error logging: {}".format(jt.errorPath))
-        jobid = s.runJob(jt)
-        logging.info('Your job has been submitted with id ' + jobid)
-        s.deleteJobTemplate(jt)
-        s.exit()
-    dry(command, runpipe, dry_run=kw.get("dry_run"))
+    jobid = submitter.submit(command, pargs.jobname, walltime=walltime)
+    if jobid and state is not None:
+        state.add(jobid, pargs.jobname, sample_batch or [])
+    return jobid
 
 def convert_to_drmaa_time(t):
     """Convert time assignment to format understood by drmaa.
@@ -164,6 +148,28 @@ def convert_to_drmaa_time(t):
     t_new = "{}:{}:{}".format(hours, minutes, seconds)
     return t_new
 
+def predict_walltime(history, sample_batch, samples, pargs):
+    """Predict the walltime of a batch from its fastq size and the
+    runtime history of the task.
+
+    :param history: :class:`ratatosk.ext.scilife.runtime.RuntimeHistory` instance, or None
+    :param sample_batch: list of sample names in batch
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param pargs: program arguments
+
+    :returns: time string formatted as hh:mm:ss, or None if there is no history for the task
+    """
+    if history is None:
+        return None
+    nbytes = fastq_bytes([smp for s in sample_batch for smp in samples[s]])
+    seconds = history.predict(pargs.task, nbytes, margin=pargs.time_margin)
+    if seconds is None:
+        logging.warn("No runtime history for task {}; using time {}".format(pargs.task, pargs.time))
+        return None
+    walltime = convert_to_drmaa_time(format_walltime(seconds))
+    logging.info("predicted walltime {} for batch of {} fastq bytes".format(walltime, nbytes))
+    return walltime
+
 def make_job_template_args(opt_d, **kw):
     """Given a dictionary of arguments, update with kw dict that holds arguments passed to argv.
 
@@ -190,6 +196,179 @@ def make_job_template_args(opt_d, **kw):
 
     return job_args
 
+def make_scheduler_command(pargs):
+    """Make the list of commands that set up the scheduler on the node.
+
+    :param pargs: program arguments
+
+    :returns: list of commands, where each command is a list of arguments
+    """
+    drmaa_cmd = []
+    # Use the local scheduler; start ratatoskd on node and wait
+    # until it accepts connections before running commands. Fail
+    # the job if it does not come up within the timeout.
+    if pargs.scheduler_host == "localhost":
+        drmaa_cmd.append([RATATOSKD, "&"])
+        drmaa_cmd.append(WAIT_FOR_SCHEDULER + ["--host", "localhost", "--port", str(RATATOSKD_PORT), "--timeout", str(pargs.scheduler_timeout), "||", "exit", "1"])
+    return drmaa_cmd
+
+def trace_file(pargs, jobname):
+    """Get the name of the resource usage trace of a job, placed
+    next to its drmaa log.
+
+    :param pargs: program arguments
+    :param jobname: job name
+
+    :returns: trace file name
+    """
+    outdir = pargs.outputPath if os.path.isdir(pargs.outputPath) else os.path.dirname(pargs.outputPath)
+    return os.path.abspath(os.path.join(outdir, "{}-trace.jsonl".format(jobname)))
+
+def targets_manifest_args(sample_batch, samples, pargs, name, pipeline=True):
+    """Write the sample runs of a batch to a target manifest, named
+    NAME-targets.json in the working directory.
+
+    :param sample_batch: list of sample names in batch
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param pargs: program arguments
+    :param name: manifest name, usually the job name
+    :param pipeline: True if the manifest is read by a pipeline task, which generates its targets from --indir and links them to --outdir itself; the sample runs are then written as located in the input directory
+
+    :returns: list of arguments that pass the manifest to ratatosk_run_scilife.py
+    """
+    manifest = os.path.abspath(os.path.join(pargs.workingDirectory, "{}-targets.json".format(name)))
+    targets = [smp for s in sample_batch for smp in samples[s]]
+    if pipeline and os.path.abspath(pargs.outdir) != os.path.abspath(pargs.indir):
+        targets = [rebase(x, pargs.outdir, pargs.indir) for x in targets]
+    if not pargs.dry_run:
+        write_manifest(manifest, targets)
+    return ['--targets-manifest', manifest]
+
+def make_batch_args(sample_batch, samples, pargs, name=None):
+    """Make the ratatosk arguments that select a batch of samples.
+
+    :param sample_batch: list of sample names in batch
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param pargs: program arguments
+    :param name: target manifest name if --targets-manifest is set; defaults to the job name
+
+    :returns: list of arguments
+    """
+    batch_args = []
+    generic = pargs.sample_target_suffix or pargs.run_target_suffix
+    if pargs.targets_manifest:
+        batch_args += targets_manifest_args(sample_batch, samples, pargs, name or pargs.jobname, pipeline=not generic)
+    # Decide whether to use explicit target names or sample names
+    if generic:
+        sfx = pargs.sample_target_suffix.lstrip("\\")
+        l = [samples[x] for x in sample_batch]
+        tasktargets = ["{}{}".format(y[0].prefix("sample"), sfx) for y in l]
+        batch_args += ['--task', pargs.task]
+        for t in tasktargets:
+            batch_args += ['--generic-wrapper-target', t]
+    elif not pargs.targets_manifest:
+        for s in sample_batch:
+            batch_args += ['--sample', s]
+    return [str(x) for x in batch_args]
+
+def make_batch_command(cmd, sample_batch, samples, pargs):
+    """Make the list of commands to run for a batch of samples.
+
+    :param cmd: ratatosk command common to all batches
+    :param sample_batch: list of sample names in batch
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param pargs: program arguments
+
+    :returns: list of commands, where each command is a list of arguments
+    """
+    drmaa_cmd = make_scheduler_command(pargs)
+    batch_cmd = [str(x) for x in cmd] + make_batch_args(sample_batch, samples, pargs)
+    if pargs.trace:
+        batch_cmd += ['--trace', trace_file(pargs, pargs.jobname)]
+    if pargs.scratch:
+        batch_cmd += ['--scratch', pargs.scratch]
+    drmaa_cmd.append(batch_cmd)
+    logging.info("passing command '{}' to drmaa...".format("\n".join([" ".join(x) for x in drmaa_cmd])))
+    return drmaa_cmd
+
+def make_cohort_command(cmd_opts, sample_names, pargs, samples=None, name=None):
+    """Make the list of commands to run the cohort task on all
+    samples.
+
+    :param cmd_opts: ratatosk options common to all commands
+    :param sample_names: list of sample names; if set, passed as --sample options
+    :param pargs: program arguments
+    :param samples: dictionary mapping sample names to lists of sample runs; written to a target manifest instead of passing sample names if --targets-manifest is set
+    :param name: target manifest name
+
+    :returns: list of commands, where each command is a list of arguments
+    """
+    drmaa_cmd = make_scheduler_command(pargs)
+    cohort_cmd = [RATATOSK_RUN, pargs.cohort_task, '--indir', pargs.indir, '--outdir', pargs.outdir,
+                  '--workers', pargs.workers, '--scheduler-host', pargs.scheduler_host] + cmd_opts
+    if pargs.targets_manifest and samples is not None:
+        cohort_cmd += targets_manifest_args(sorted(samples.keys()), samples, pargs, name)
+    else:
+        for s in sample_names:
+            cohort_cmd += ['--sample', s]
+    drmaa_cmd.append([str(x) for x in cohort_cmd])
+    logging.info("passing cohort command '{}' to drmaa...".format("\n".join([" ".join(x) for x in drmaa_cmd])))
+    return drmaa_cmd
+
+def submit_cohort(cmd_opts, sample_names, pargs, submitter, state, jobname, samples=None):
+    """Submit the cohort task as a job that starts when all
+    previously submitted jobs have completed successfully.
+
+    :param cmd_opts: ratatosk options common to all commands
+    :param sample_names: list of sample names passed to the cohort task
+    :param pargs: program arguments
+    :param submitter: :class:`ratatosk.ext.scilife.cluster.DrmaaSubmitter` instance
+    :param state: :class:`ratatosk.ext.scilife.jobstate.JobState` instance in which the job is recorded
+    :param jobname: job name
+    :param samples: dictionary mapping all sample names to lists of sample runs, used for the target manifest
+
+    :returns: job id, or None if dry run
+    """
+    command = "\n".join([" ".join(x) for x in make_cohort_command(cmd_opts, sample_names, pargs, samples, jobname)])
+    jobid = submitter.submit(command, jobname, depends=list(submitter.jobids))
+    if jobid:
+        state.add(jobid, jobname, [])
+    return jobid
+
+def write_batch_manifest(manifest, batches, samples, pargs):
+    """Write the ratatosk arguments of each batch to a manifest file,
+    one batch per line. Line n is run by array task n.
+
+    :param manifest: manifest file name
+    :param batches: list of sample batches
+    :param samples: dictionary mapping sample names to lists of sample runs
+    :param pargs: program arguments
+    """
+    with open(manifest, "w") as fh:
+        for i, sample_batch in enumerate(batches):
+            fh.write(" ".join(make_batch_args(sample_batch, samples, pargs, "{}_{}".format(pargs.jobname, i + 1))) + "\n")
+
+def make_array_command(cmd, manifest, pargs):
+    """Make the list of commands to run for an array task. The task
+    reads its batch arguments from the line in the manifest given by
+    the array task index.
+
+    :param cmd: ratatosk command common to all batches
+    :param manifest: manifest file name, as written by write_batch_manifest
+    :param pargs: program arguments
+
+    :returns: list of commands, where each command is a list of arguments
+    """
+    drmaa_cmd = make_scheduler_command(pargs)
+    batch_cmd = [str(x) for x in cmd] + ['$(sed -n "${{{}}}p" {})'.format(ARRAY_TASK_ID, os.path.abspath(manifest))]
+    if pargs.trace:
+        batch_cmd += ['--trace', trace_file(pargs, "{}_${{{}}}".format(pargs.jobname, ARRAY_TASK_ID))]
+    if pargs.scratch:
+        batch_cmd += ['--scratch', pargs.scratch]
+    drmaa_cmd.append(batch_cmd)
+    logging.info("passing array command '{}' to drmaa...".format("\n".join([" ".join(x) for x in drmaa_cmd])))
+    return drmaa_cmd
+
 
 if __name__ == "__main__":
     if not os.getenv("DRMAA_LIBRARY_PATH"):
@@ -218,6 +397,10 @@ if __name__ == "__main__":
     #                     help='number of cores to use.', choices=xrange(1,9))
     group.add_argument('-t', '--time', type=str, default="10:00:00",
                         help='run time')
+    group.add_argument('--predict-time', action="store_true", default=False,
+                        help='predict the run time of each batch from its fastq size and the runtime history recorded by ratatosk_run_scilife.py (setting runtime_history); falls back to --time if there is no history')
+    group.add_argument('--time-margin', type=float, default=1.5,
+                        help='safety margin multiplied with the predicted run time')
     group.add_argument('-J', '--jobname', type=str, default="ratatosk",
                         help='job name')
     group.add_argument('-D', '--workingDirectory', type=str, default=os.curdir,
@@ -226,6 +409,18 @@ if __name__ == "__main__":
                         help='output path for stdout')
     group.add_argument('-e', '--errorPath', type=str, default=os.curdir,
                         help='output path for stderr')
+    group.add_argument('--array', action="store_true", default=False,
+                        help='submit all batches as one array job; the batch arguments are written to a manifest file and each array task picks its batch by array index')
+    group.add_argument('--manifest', type=str, default=None,
+                        help='manifest file for array jobs; defaults to JOBNAME-batches.txt in the working directory')
+    group.add_argument('--scheduler-timeout', type=int, default=120,
+                        help='seconds to wait for the ratatoskd scheduler, started on the node when --scheduler-host is localhost, to accept connections on port {} before the job fails'.format(RATATOSKD_PORT))
+    group.add_argument('--state-file', type=str, default=None,
+                        help='file in which submitted job ids are recorded for ratatosk_job_status.py; defaults to JOBNAME-jobs.json in the working directory. Jobs are added to an existing state file of the same project; an explicitly given state file of another project is replaced')
+    group.add_argument('--trace', action="store_true", default=False,
+                        help='write a JSON-lines trace of per-task run time, CPU time, peak memory and I/O of every batch, named JOBNAME-trace.jsonl next to the drmaa log')
+    group.add_argument('--scratch', type=str, default=None,
+                        help='node-local scratch directory, e.g. \'$TMPDIR\' (quoted so that it is expanded on the node); each batch copies its inputs there, runs the pipeline there and copies back the outputs configured in setting stage_outputs, or runs in place if scratch is too small')
     group.add_argument('--email', type=str, default=None,
                         help='email address to send job information to')
     group.add_argument('--extra', type=str, default=[],
@@ -242,8 +437,22 @@ if __name__ == "__main__":
                               help='lanes to process',  action="append")
     sample_group.add_argument('--flowcell', type=str, default=None, 
                               help='flowcells to process', action="append")
+    sample_group.add_argument('--index', action="store_true", default=False,
+                              help='create/update a project index next to the input directory to speed up repeated target generation; batch jobs use it read-only')
+    sample_group.add_argument('--stream', action="store_true", default=False,
+                              help='discover samples one sample directory at a time and submit batches as soon as they are complete')
     sample_group.add_argument('-B', '--batch_size', type=int, default=4,
                               help='number of samples to process per node')
+    sample_group.add_argument('--pack-by', type=str, default="count", choices=PACK_BY,
+                              help='weigh samples by count, number of sample runs or total fastq bytes and pack batches to balance the weight per node; --batch_size sets the maximum number of samples per batch')
+    sample_group.add_argument('--resume', action="store_true", default=False,
+                              help='only submit samples whose final target does not exist')
+    sample_group.add_argument('--final-target-suffix', type=str, default=None,
+                              help='suffix of the final sample target checked by --resume; defaults to --sample-target-suffix')
+    sample_group.add_argument('--targets-manifest', action="store_true", default=False,
+                              help='write the sample runs of each batch to a target manifest JOBNAME-targets.json in the working directory and pass it to ratatosk_run_scilife.py, so that jobs do not rediscover targets and sample names need not be passed on the command line')
+    sample_group.add_argument('--cohort-task', type=str, default=None,
+                              help='task that needs all samples, e.g. CombineVariants; submitted as one job that starts when all sample batches have completed successfully')
     sample_group.add_argument('-1', '--sample-target-suffix', type=str, default=None,
                               help='target suffix to add to the sample target (position 1 in target generator tuple)')
     sample_group.add_argument('-2', '--run-target-suffix', type=str, default=None,
@@ -270,46 +479,34 @@ if __name__ == "__main__":
 
     # Parse arguments
     pargs = parser.parse_args()
+    if pargs.array and pargs.stream:
+        parser.error("--array and --stream are mutually exclusive")
+    resume_suffix = pargs.final_target_suffix or pargs.sample_target_suffix
+    if pargs.resume and not resume_suffix:
+        parser.error("--resume requires --final-target-suffix or --sample-target-suffix")
+    if pargs.stream and pargs.pack_by != "count":
+        logging.warn("--pack-by {} is ignored in streaming mode".format(pargs.pack_by))
 
     # If we have a config file, read it and see if we have a
     # target_generator_handler in settings
     tgt_gen_fun = target_generator
-    if pargs.config_file:
-        with open(pargs.config_file) as fh:
-            config = yaml.load(fh)
-        if config and config.get("settings", {}).get("target_generator_handler", None):
-            h = RatatoskHandler(label="target_generator_handler", mod=config.get("settings", {}).get("target_generator_handler"))
-            hdl = _load(h)
-            if hdl:
-                tgt_gen_fun = hdl
-    if pargs.custom_config:
-        with open(pargs.custom_config) as fh:
+    settings = {}
+    for cfg in [pargs.config_file, pargs.custom_config]:
+        if not cfg:
+            continue
+        with open(cfg) as fh:
             config = yaml.load(fh)
-        if config and config.get("settings", {}).get("target_generator_handler", None):
+        if not config or not config.get("settings", None):
+            continue
+        settings.update(config.get("settings"))
+        if config.get("settings", {}).get("target_generator_handler", None):
             h = RatatoskHandler(label="target_generator_handler", mod=config.get("settings", {}).get("target_generator_handler"))
             hdl = _load(h)
             if hdl:
                 tgt_gen_fun = hdl
 
-    # Collect information about what samples to run, and on how many
-    # nodes. This is somewhat convoluted since ratatosk_run_scilife
-    # also collects sample information, but this step is necessary as
-    # we need to wrap ratatosk_run_scilife.py in drmaa
-    targets = tgt_gen_fun(indir=pargs.indir, sample=pargs.sample,
-                          flowcell=pargs.flowcell, lane=pargs.lane)
-    # After getting run list, if output directory is different to
-    # input directory, link raw data files to output directory and
-    # remember to use this directory for ratatosk tasks. In this way
-    # we actually can run on subsets of sample runs or flowcells
     if not pargs.outdir:
         pargs.outdir = pargs.indir
-    if pargs.outdir != pargs.indir:
-        targets = make_fastq_links(targets, pargs.indir, pargs.outdir)
-    # Group samples
-    sorted_samples = sorted(targets, key=lambda t:t.sample_id())
-    samples = {}
-    for k, g in itertools.groupby(sorted_samples, key=lambda t:t.sample_id()):
-        samples[k] = list(g)
 
     # Initialize command
     if pargs.sample_target_suffix or pargs.run_target_suffix:
@@ -318,18 +515,21 @@ if __name__ == "__main__":
     else:
         cmd = [RATATOSK_RUN, pargs.task, '--indir', pargs.indir, '--outdir', pargs.outdir, 
                '--workers', pargs.workers, '--scheduler-host', pargs.scheduler_host]
+    # Options common to the batch and cohort commands
+    cmd_opts = []
     if pargs.config_file:
         logging.info("setting config to {}".format(pargs.config_file))
-        cmd += ['--config-file', pargs.config_file]
+        cmd_opts += ['--config-file', pargs.config_file]
     if pargs.custom_config:
         logging.info("setting custom config to {}".format(pargs.custom_config))
-        cmd += ['--custom-config', pargs.custom_config]
+        cmd_opts += ['--custom-config', pargs.custom_config]
     if pargs.flowcell:
         for fc in pargs.flowcell:
-            cmd += ['--flowcell', fc]
+            cmd_opts += ['--flowcell', fc]
     if pargs.lane:
         for lane in pargs.lane:
-            cmd += ['--lane', lane]
+            cmd_opts += ['--lane', lane]
+    cmd += cmd_opts
 
     # If devel job requested, set time to 1 h if pargs.time is greater
     if pargs.partition == "devel":
@@ -340,42 +540,142 @@ if __name__ == "__main__":
             logging.info("resetting devel job time from {} to 01:00:00".format(pargs.time))
             pargs.time = "01:00:00"
 
-    # Submit batch jobs
-    batches = [sorted(samples.keys())[x:x+pargs.batch_size] for x in xrange(0, len(samples.keys()), pargs.batch_size)]
-    batchid = 1
+    tgt_kw = {'indir' : pargs.indir, 'sample' : pargs.sample, 'flowcell' : pargs.flowcell, 'lane' : pargs.lane,
+              'index' : True if pargs.index else None,
+              'scan_workers' : settings.get("target_generator_workers", None)}
+    link_workers = settings.get("link_workers", 8)
     jobname_default = pargs.jobname
-    if len(batches) > 0 and query_yes_no("Going to start {} jobs... Are you sure you want to continue?".format(len(batches))):
+    # One drmaa session and job template is used for all submissions
+    submitter = DrmaaSubmitter(make_job_template_args(opt_to_dict(pargs.extra), **vars(pargs)), dry_run=pargs.dry_run)
+    # Runtime history for walltime prediction
+    history = None
+    if pargs.predict_time and pargs.partition != "devel":
+        history = RuntimeHistory(settings.get("runtime_history", HISTORY_FILE))
+    # Record submitted jobs for ratatosk_job_status.py
+    state = JobState(pargs.state_file or os.path.join(pargs.workingDirectory, "{}-jobs.json".format(jobname_default)), project=os.path.abspath(pargs.indir))
+    if os.path.exists(state.filename):
+        recorded = JobState(state.filename)
+        recorded.load()
+        # Resubmitted jobs are added to the jobs already recorded for
+        # the project
+        if recorded.project == state.project:
+            state = recorded
+            logging.info("adding jobs to state file {} with {} recorded jobs".format(state.filename, len(state.jobs)))
+        elif not pargs.state_file:
+            parser.error("state file {} records jobs of project {}; use another --jobname or set --state-file".format(state.filename, recorded.project))
+        else:
+            logging.warn("state file {} records jobs of project {}; replacing them".format(state.filename, recorded.project))
+
+    # The drmaa session is closed however submission ends
+    try:
+        # Streaming mode: discover samples one sample directory at a time
+        # and submit each batch as soon as it is complete
+        if pargs.stream:
+            if not query_yes_no("Going to start jobs as samples are discovered... Are you sure you want to continue?"):
+                sys.exit()
+            batchid = 1
+            sample_batch = []
+            samples = {}
+            # All sample runs, kept for the cohort target manifest
+            all_samples = {} if pargs.cohort_task and pargs.targets_manifest else None
+            for k, g in itertools.groupby(iter_targets(generator=tgt_gen_fun, **tgt_kw), key=lambda t:t.sample_id()):
+                samples[k] = list(g)
+                if pargs.outdir != pargs.indir:
+                    samples[k] = make_fastq_links(samples[k], pargs.indir, pargs.outdir, workers=link_workers)
+                if all_samples is not None:
+                    all_samples[k] = samples[k]
+                if pargs.resume and os.path.exists(final_target(samples[k], resume_suffix)):
+                    logging.info("skipping sample {}: final target exists".format(k))
+                    del samples[k]
+                    continue
+                sample_batch.append(k)
+                if len(sample_batch) < pargs.batch_size:
+                    continue
+                pargs.jobname = "{}_{}".format(jobname_default, batchid)
+                batchid += 1
+                drmaa_wrapper(make_batch_command(cmd, sample_batch, samples, pargs), pargs, submitter, state, sample_batch,
+                              predict_walltime(history, sample_batch, samples, pargs))
+                for s in sample_batch:
+                    del samples[s]
+                sample_batch = []
+                if pargs.partition == "devel":
+                    logging.warn("only submitting 1 devel job... skipping remaining tasks")
+                    sys.exit()
+            if sample_batch:
+                pargs.jobname = "{}_{}".format(jobname_default, batchid)
+                drmaa_wrapper(make_batch_command(cmd, sample_batch, samples, pargs), pargs, submitter, state, sample_batch,
+                              predict_walltime(history, sample_batch, samples, pargs))
+            if pargs.cohort_task and pargs.partition != "devel":
+                submit_cohort(cmd_opts, pargs.sample or [], pargs, submitter, state, "{}_cohort".format(jobname_default), all_samples)
+            sys.exit()
+
+        # Collect information about what samples to run, and on how many
+        # nodes. This is somewhat convoluted since ratatosk_run_scilife
+        # also collects sample information, but this step is necessary as
+        # we need to wrap ratatosk_run_scilife.py in drmaa
+        targets = tgt_gen_fun(**tgt_kw)
+        # After getting run list, if output directory is different to
+        # input directory, link raw data files to output directory and
+        # remember to use this directory for ratatosk tasks. In this way
+        # we actually can run on subsets of sample runs or flowcells
+        if pargs.outdir != pargs.indir:
+            targets = make_fastq_links(targets, pargs.indir, pargs.outdir, workers=link_workers)
+        # Group samples
+        sorted_samples = sorted(targets, key=lambda t:t.sample_id())
+        samples = {}
+        for k, g in itertools.groupby(sorted_samples, key=lambda t:t.sample_id()):
+            samples[k] = list(g)
+
+        all_samples = samples
+        # Only keep samples whose final target is missing
+        if pargs.resume:
+            incomplete = incomplete_samples(samples, resume_suffix)
+            logging.info("resuming: {} of {} samples are incomplete".format(len(incomplete), len(samples)))
+            samples = dict((k, samples[k]) for k in incomplete)
+
+        # Submit batch jobs
+        weights = dict((k, sample_weight(v, pargs.pack_by)) for k, v in samples.items())
+        batches = pack_batches(weights, pargs.batch_size)
+        if pargs.dry_run:
+            for load in batch_load_report(batches, samples):
+                logging.info("(DRY_RUN): batch {batch}: {samples} samples, {runs} sample runs, {bytes} fastq bytes".format(**load))
+        batchid = 1
+        # Array mode: submit all batches as one array job
+        if pargs.array:
+            if pargs.partition == "devel" and len(batches) > 1:
+                logging.warn("only submitting 1 devel job... skipping remaining tasks")
+                batches = batches[0:1]
+            if len(batches) > 0 and not query_yes_no("Going to start an array job with {} tasks... Are you sure you want to continue?".format(len(batches))):
+                sys.exit()
+            if len(batches) > 0:
+                manifest = pargs.manifest or os.path.join(pargs.workingDirectory, "{}-batches.txt".format(jobname_default))
+                if not pargs.dry_run:
+                    write_batch_manifest(manifest, batches, samples, pargs)
+                    logging.info("wrote {} batches to manifest {}".format(len(batches), manifest))
+                command = "\n".join([" ".join(x) for x in make_array_command(cmd, manifest, pargs)])
+                walltimes = [predict_walltime(history, x, samples, pargs) for x in batches]
+                walltime = max(walltimes, key=lambda x:[int(y) for y in x.split(":")]) if None not in walltimes else None
+                jobids = submitter.submit_bulk(command, jobname_default, len(batches), walltime)
+                for jobid, sample_batch in zip(jobids or [], batches):
+                    state.add(jobid, jobname_default, sample_batch, save=False)
+                if jobids:
+                    state.save()
+            if pargs.cohort_task and pargs.partition != "devel":
+                submit_cohort(cmd_opts, pargs.sample or [], pargs, submitter, state, "{}_cohort".format(jobname_default), all_samples)
+            sys.exit()
+        if len(batches) > 0 and not query_yes_no("Going to start {} jobs... Are you sure you want to continue?".format(len(batches))):
+            sys.exit()
         for sample_batch in batches:
-            drmaa_cmd = []
-            # Use the local scheduler; start ratatoskd on node, wait
-            # 10 seconds to make sure it has started before running
-            # commands
-            if pargs.scheduler_host == "localhost":
-                drmaa_cmd.append([RATATOSKD, "&"])
-                drmaa_cmd.append(["sleep 10"])
-            batch_cmd = copy.deepcopy(cmd)
             if len(batches) > 1:
                 pargs.jobname = "{}_{}".format(jobname_default, batchid)
                 batchid += 1
-            # Decide whether to use explicit target names or sample names
-            if pargs.sample_target_suffix or pargs.run_target_suffix:
-                sfx = pargs.sample_target_suffix.lstrip("\\")
-                l = [samples[x] for x in sample_batch]
-                tasktargets = ["{}{}".format(y[0][1], sfx) for y in l]
-                batch_cmd += ['--task', pargs.task]
-                for t in tasktargets:
-                    batch_cmd += ['--generic-wrapper-target', t]
-                batch_cmd = [str(x) for x in batch_cmd]
-                drmaa_cmd.append(batch_cmd)
-            else:
-                l = [samples[x] for x in sample_batch]
-                samplelist = [item for sublist in l for item in sublist] 
-                for s in sample_batch:
-                    batch_cmd += ['--sample', s]
-                batch_cmd = [str(x) for x in batch_cmd]
-                drmaa_cmd.append(batch_cmd)
-            logging.info("passing command '{}' to drmaa...".format("\n".join([" ".join(x) for x in drmaa_cmd])))
-            drmaa_wrapper(drmaa_cmd, pargs)
+            drmaa_wrapper(make_batch_command(cmd, sample_batch, samples, pargs), pargs, submitter, state, sample_batch,
+                          predict_walltime(history, sample_batch, samples, pargs))
             if pargs.partition == "devel":
                 logging.warn("only submitting 1 devel job... skipping remaining tasks")
                 break
+        # Cohort step: one job that starts when all batches have completed
+        if pargs.cohort_task and pargs.partition != "devel":
+            submit_cohort(cmd_opts, pargs.sample or [], pargs, submitter, state, "{}_cohort".format(jobname_default), all_samples)
+    finally:
+        submitter.close()
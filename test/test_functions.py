@@ -15,8 +15,26 @@ import os
 import shutil
 import unittest
 import logging
+import socket
 import ratatosk.lib.files.input
+from ratatosk import backend
 from ratatosk.ext.scilife.sample import *
+from ratatosk.ext.scilife.sample import _sample_runs_cache
+from ratatosk.ext.scilife.illumina import parse_fastq_filename
+from ratatosk.ext.scilife.projectindex import index_path, open_index
+from ratatosk.ext.scilife.bcbio import bcbio_config_to_sample_sheet
+from ratatosk.ext.scilife.batch import sample_weight, pack_batches, fastq_files, incomplete_samples
+from ratatosk.ext.scilife.cluster import wait_for_scheduler, dependency_ids
+from ratatosk.ext.scilife.links import make_fastq_links, plan_fastq_links
+from ratatosk.ext.scilife.jobstate import JobState, progress, expand_jobid
+from ratatosk.ext.scilife.runtime import RuntimeHistory, format_walltime
+from ratatosk.ext.scilife.trace import summarize_traces
+from ratatosk.ext.scilife.targetfilter import TargetFilter
+from ratatosk.ext.scilife.manifest import write_manifest, load_manifest, manifest_targets
+from ratatosk.ext.scilife.staging import Stager
+from ratatosk.ext.scilife.piperunner import run_pipeline
+from ratatosk.ext.scilife.chunks import run_chunks, split_chunk_prefix
+from ratatosk.ext.scilife.bench import _parse_times
 
 
 class Task(object):
@@ -54,6 +72,8 @@ class TestFunctions(unittest.TestCase):
     def tearDown(self):
         if os.path.exists("tmp"):
             shutil.rmtree("tmp")
+        if os.path.exists(index_path(self.project)):
+            os.unlink(index_path(self.project))
 
     def test_tg_all(self):
         """Test getting all sample runs from a project"""
@@ -77,15 +97,296 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(sorted([os.path.basename(os.path.dirname(x.prefix("sample_run"))) for x in tl]), ['120924_AC003CCCXX', '120924_AC003CCCXX'])
         self.assertEqual(sorted([os.path.basename(x.sample_id()) for x in tl]), ['P001_101_index3', 'P001_101_index3'])
 
+    def test_iter_targets(self):
+        """Test lazy target generation in sorted sample order"""
+        it = iter_targets(indir=self.project)
+        self.assertEqual(next(it).sample_id(), 'P001_101_index3')
+        self.assertEqual([x.sample_id() for x in iter_targets(indir=self.project)], ['P001_101_index3'] * 3 + ['P001_102_index6'] * 2)
+
+    def test_tg_index(self):
+        """Test getting sample runs via a project index"""
+        mtime = os.stat(self.project).st_mtime
+        tl = target_generator(indir=self.project, index=True)
+        self.assertTrue(os.path.exists(index_path(self.project)))
+        self.assertEqual(os.stat(self.project).st_mtime, mtime)
+        tl_idx = target_generator(indir=self.project)
+        self.assertEqual(sorted([x.prefix("sample_run") for x in tl]), sorted([x.prefix("sample_run") for x in tl_idx]))
+        idx = open_index(self.project)
+        self.assertTrue(idx.readonly)
+        idx.close()
+        # Prefixes follow the project directory of the caller
+        tl_abs = target_generator(indir=os.path.abspath(self.project))
+        self.assertEqual(sorted([x.prefix("sample_run") for x in tl_abs]), sorted([os.path.abspath(x.prefix("sample_run")) for x in tl]))
+        self.assertEqual(set([x.prefix("project") for x in tl_abs]), set([os.path.abspath(self.project)]))
+        self.assertEqual(set([x.prefix("project") for x in tl_idx]), set([self.project]))
+
+    def test_generic_tg_scan_workers(self):
+        """Test that parallel directory scanning gives the same targets as serial scanning"""
+        tl = generic_target_generator(indir=self.project, scan_workers=1)
+        tl_par = generic_target_generator(indir=self.project, scan_workers=4)
+        self.assertEqual([x.prefix("sample_run") for x in tl], [x.prefix("sample_run") for x in tl_par])
+        self.assertIn(os.path.join(self.project, self.sample, self.flowcell, "P001_101_index3_TGACCA_L001"), [x.prefix("sample_run") for x in tl])
+
+    def test_parse_fastq_filename(self):
+        """Test parsing Illumina fastq file names"""
+        fq = parse_fastq_filename(os.path.join(self.project, self.sample, self.flowcell, "P001_101_index3_TGACCA_L002_R2_002.fastq.gz"))
+        self.assertEqual((fq.sample, fq.index, fq.lane, fq.read, fq.chunk), ("P001_101_index3", "TGACCA", "002", "2", "002"))
+        self.assertEqual(fq.prefix, os.path.join(self.project, self.sample, self.flowcell, "P001_101_index3_TGACCA_L002"))
+        fq = parse_fastq_filename("sample_1.fq")
+        self.assertEqual((fq.prefix, fq.read, fq.chunk), ("sample", None, "1"))
+        self.assertIsNone(parse_fastq_filename("sample.fastq.gz"))
+
+    def test_read_sample_sheet(self):
+        """Test reading a sample sheet with comments and short rows"""
+        os.makedirs(os.path.join("tmp", self.flowcell))
+        with open(os.path.join("tmp", self.flowcell, "SampleSheet.csv"), "w") as fh:
+            fh.write("\n".join(["# Comment",
+                                "FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,Operator,SampleProject",
+                                "C003CCCXX,1,P001_101_index3,hg19,TGACCA,J__Doe_00_01,N,R1,NN,J__Doe_00_01",
+                                "C003CCCXX,2,P001_102_index6", ""]))
+        ssheet = read_sample_sheet(os.path.join("tmp", self.flowcell), self.sample, self.flowcell)
+        self.assertEqual([(x['Lane'], x['Index']) for x in ssheet], [('1', 'TGACCA'), ('2', None)])
+        self.assertEqual(len(ssheet[1]), 10)
+
+    def test_bcbio_config_to_sample_sheet(self):
+        """Test that converting bcbio config files only saves SampleSheet.csv if missing or stale"""
+        os.makedirs(os.path.join("tmp", self.flowcell))
+        config = os.path.join("tmp", self.flowcell, "P001_101_index3-bcbb-config.yaml")
+        ssheet = os.path.join("tmp", self.flowcell, "SampleSheet.csv")
+        with open(config, "w") as fh:
+            fh.write("details:\n  - flowcell_id: AC003CCCXX\n    lane: 1\n    genome_build: hg19\n    multiplex:\n      - name: P001_101_index3\n        sequence: TGACCA\n        sample_prj: J.Doe_00_01\n")
+        rows = bcbio_config_to_sample_sheet(config)
+        self.assertEqual([(x['SampleID'], x['Index'], x['SampleProject']) for x in rows], [('P001_101_index3', 'TGACCA', 'J.Doe_00_01')])
+        self.assertTrue(os.path.exists(ssheet))
+        with open(ssheet, "w") as fh:
+            fh.write("up to date")
+        os.utime(ssheet, (os.stat(config).st_mtime + 10, os.stat(config).st_mtime + 10))
+        self.assertEqual(bcbio_config_to_sample_sheet(config), rows)
+        with open(ssheet) as fh:
+            self.assertEqual(fh.read(), "up to date")
+
+    def test_pack_batches(self):
+        """Test packing samples into batches with balanced weight"""
+        self.assertEqual(pack_batches({'a' : 1, 'b' : 1, 'c' : 1}, 2), [['a', 'b'], ['c']])
+        self.assertEqual(pack_batches({'a' : 10, 'b' : 1, 'c' : 1, 'd' : 8}, 2), [['a', 'c'], ['b', 'd']])
+        tl = target_generator(indir=self.project, sample=[self.sample])
+        self.assertEqual(sample_weight(tl, "runs"), 3)
+        self.assertEqual(sorted([len(fastq_files(x)) for x in tl]), [2, 2, 2])
+        # Files of other sample runs sharing the prefix are not counted
+        os.makedirs(os.path.join("tmp", "S"))
+        for f in ["S_L001_R1_001.fastq.gz", "S_L0011_R1_001.fastq.gz", "S_L001_x_R1_001.fastq.gz", "S_L001_R1_001_trimmed.fastq.gz"]:
+            open(os.path.join("tmp", "S", f), "w").close()
+        smp = Sample(project_id="tmp", sample_id="S", project_prefix="tmp", sample_prefix=os.path.join("tmp", "S", "S"),
+                     sample_run_prefix=os.path.join("tmp", "S", "S_L001"))
+        self.assertEqual(fastq_files(smp), [os.path.join("tmp", "S", "S_L001_R1_001.fastq.gz")])
+
+    def test_incomplete_samples(self):
+        """Test finding samples whose final target is missing"""
+        samples = {}
+        for s in ['P001_101_index3', 'P001_102_index6']:
+            os.makedirs(os.path.join("tmp", s))
+            samples[s] = [Sample(project_id="tmp", sample_id=s, project_prefix="tmp", sample_prefix=os.path.join("tmp", s, s),
+                                 sample_run_prefix=os.path.join("tmp", s, self.flowcell, s))]
+        with open(os.path.join("tmp", "P001_101_index3", "P001_101_index3.sort.merge.bam"), "w") as fh:
+            fh.write("")
+        self.assertEqual(incomplete_samples(samples, ".sort.merge.bam"), ['P001_102_index6'])
+
+    def test_runtime_history(self):
+        """Test predicting walltime from runtime history"""
+        os.makedirs("tmp")
+        history = RuntimeHistory(os.path.join("tmp", "runtime.sqlite"))
+        self.assertIsNone(history.predict("HaloPlex", 1000))
+        history.record("HaloPlex", 1000, 3600)
+        history.record("HaloPlex", 3000, 14400)
+        history.record("Align", 2000, 3600)
+        self.assertEqual(history.predict("HaloPlex", 2000, margin=1.0), 9000)
+        self.assertEqual(history.predict("HaloPlex", 10, margin=1.0), 3600)
+        history.close()
+        self.assertEqual(format_walltime(10800 + 61), "03:01:01")
+
+    def test_summarize_traces(self):
+        """Test summarizing task traces"""
+        os.makedirs("tmp")
+        with open(os.path.join("tmp", "ratatosk_1-trace.jsonl"), "w") as fh:
+            fh.write('{"task": "BwaAln", "seconds": 10.0, "cpu_user": 30.0, "cpu_system": 1.0, "maxrss_kb": 500, "read_bytes": 100, "write_bytes": 50}\n')
+            fh.write('{"task": "MergeSamFiles", "seconds": 20.0, "cpu_user": 15.0, "cpu_system": 2.0, "maxrss_kb": 900, "read_bytes": null, "write_bytes": null}\n')
+            fh.write('{"task": "BwaAln", "seconds": 15.0, "cpu_user": 40.0, "cpu_system": 1.0, "maxrss_kb": 700, "read_bytes": 200, "write_bytes": 60}\n')
+        summary = summarize_traces([os.path.join("tmp", "ratatosk_1-trace.jsonl")])
+        self.assertEqual([x['task'] for x in summary], ["BwaAln", "MergeSamFiles"])
+        self.assertEqual((summary[0]['n'], summary[0]['seconds'], summary[0]['cpu'], summary[0]['maxrss_kb'], summary[0]['read_bytes']), (2, 25.0, 72.0, 700, 300))
+
+    def test_wait_for_scheduler(self):
+        """Test waiting for a scheduler port to accept connections"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("localhost", 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        try:
+            self.assertTrue(wait_for_scheduler("localhost", port, timeout=1))
+        finally:
+            sock.close()
+        self.assertFalse(wait_for_scheduler("localhost", port, timeout=0.2))
+
+    def test_dependency_ids(self):
+        """Test that cohort dependencies on array jobs use the array job id"""
+        self.assertEqual(dependency_ids(["101", "102.1", "102.2", "103_1"]), ["101", "102", "103"])
+
+    def test_make_fastq_links(self):
+        """Test bulk linking of fastq files to an output directory"""
+        tl = target_generator(indir=self.project, sample=[self.sample])
+        (dirs, links, newtargets) = plan_fastq_links(tl, self.project, "tmp")
+        self.assertEqual(dirs, [os.path.join("tmp", self.sample, "120924_AC003CCCXX"), os.path.join("tmp", self.sample, "121015_BB002BBBXX")])
+        newtargets = make_fastq_links(tl, self.project, "tmp", workers=4)
+        self.assertEqual(sorted([x.prefix("sample_run") for x in newtargets]), sorted([os.path.join("tmp", os.path.relpath(x.prefix("sample_run"), self.project)) for x in tl]))
+        for (src, dst) in links:
+            self.assertEqual(os.readlink(dst), src)
+        make_fastq_links(tl, self.project, "tmp")
+        self.assertEqual(len(os.listdir(os.path.join("tmp", self.sample, "121015_BB002BBBXX"))), 3)
+
+    def test_target_filter(self):
+        """Test glob and lane filters in the target generators"""
+        tl = target_generator(indir=self.project, sample=["P001_10*"], lane=[2])
+        self.assertEqual(sorted(set([os.path.basename(x.prefix("sample_run")) for x in tl])), ["P001_101_index3_TGACCA_L002", "P001_102_index6_ACAGTG_L002"])
+        self.assertTrue(all(x.prefix("sample_run").endswith("_L002") for x in tl))
+        tl = generic_target_generator(indir=self.project, sample=["P001_10*"], flowcell=["121015_*"], barcode=["TGACCA"])
+        self.assertEqual(set([os.path.basename(x.prefix("sample_run")) for x in tl]), set(["P001_101_index3_TGACCA_L001"]))
+        tf = TargetFilter(lane=["001"], project=["J.Doe_00_01"])
+        self.assertEqual(len(target_generator(indir=self.project, target_filter=tf)), len(target_generator(indir=self.project, lane=[1])))
+        self.assertEqual(target_generator(indir=self.project, project=["J.Doe_00_02"]), [])
+
+    def test_targets_manifest(self):
+        """Test serving targets from a target manifest"""
+        os.makedirs("tmp")
+        tl = target_generator(indir=self.project)
+        write_manifest(os.path.join("tmp", "targets.json"), [x for x in tl if x.sample_id() == self.sample])
+        try:
+            targets = load_manifest(os.path.join("tmp", "targets.json"))
+            self.assertEqual([x.prefix("sample_run") for x in targets], [x.prefix("sample_run") for x in tl if x.sample_id() == self.sample])
+            self.assertEqual(len(target_generator(indir=self.project)), 3)
+            self.assertEqual(len(generic_target_generator(indir=self.project, lane=[2])), 1)
+            self.assertEqual(target_generator(indir=self.project, sample=["P001_102_index6"]), [])
+            self.assertEqual(target_generator(indir="tmp"), [])
+            self.assertIsNone(manifest_targets("tmp"))
+        finally:
+            del backend.__global_vars__["manifest"]
+            del backend.__global_vars__["targets"]
+
+    def test_staging(self):
+        """Test staging a batch on scratch and copying back outputs"""
+        os.makedirs(os.path.join("tmp", "scratch"))
+        tl = target_generator(indir=self.project, sample=[self.sample])
+        self.assertIsNone(Stager(self.project, os.path.join("tmp", "out"), os.path.join("tmp", "noscratch")).stage(tl))
+        stager = Stager(self.project, os.path.join("tmp", "out"), os.path.join("tmp", "scratch"), outputs=[".sort.merge.bam"], interval=0.01)
+        staged = stager.stage(tl)
+        self.assertEqual(len(staged), len(tl))
+        self.assertTrue(all(os.path.exists(x) for x in fastq_files(staged[0])))
+        for sfx in [".sort.merge.bam", ".sort.bam"]:
+            with open(os.path.join(stager.stagedir, self.sample, self.sample + sfx), "w") as fh:
+                fh.write(sfx)
+        stager.add(os.path.join(stager.stagedir, self.sample, self.sample + ".sort.merge.bam"))
+        self.assertEqual(stager.finish(), [])
+        self.assertEqual(os.listdir(os.path.join("tmp", "out", self.sample)), [self.sample + ".sort.merge.bam"])
+        self.assertEqual(os.listdir(os.path.join("tmp", "scratch")), [])
+        # Outputs are required, and existing outputs are seeded
+        self.assertIsNone(Stager(self.project, os.path.join("tmp", "out"), os.path.join("tmp", "scratch")).stage(tl))
+        stager = Stager(self.project, os.path.join("tmp", "out"), os.path.join("tmp", "scratch"), outputs=[".sort.merge.bam"], interval=0.01)
+        stager.stage(tl)
+        self.assertTrue(os.path.exists(os.path.join(stager.stagedir, self.sample, self.sample + ".sort.merge.bam")))
+        self.assertEqual(stager.finish(cleanup=False), [])
+        self.assertTrue(os.path.isdir(stager.stagedir))
+        stager.cleanup()
+
+    def test_run_pipeline(self):
+        """Test running commands connected by pipes"""
+        os.makedirs("tmp")
+        with open(os.path.join("tmp", "out.txt"), "w") as fh:
+            self.assertEqual(run_pipeline([["printf", "b\\na\\nb\\n"], ["sort"], ["uniq"]], stdout=fh), [0, 0, 0])
+        with open(os.path.join("tmp", "out.txt")) as fh:
+            self.assertEqual(fh.read(), "a\nb\n")
+        self.assertRaises(RuntimeError, run_pipeline, [["sh", "-c", "exit 3"], ["cat"]])
+        self.assertRaises(RuntimeError, run_pipeline, [["printf", "a"], ["no-such-program-in-path"]])
+
+    def test_job_state(self):
+        """Test recording jobs and summarizing progress"""
+        os.makedirs("tmp")
+        state = JobState(os.path.join("tmp", "ratatosk-jobs.json"), project=self.project)
+        state.add("101", "ratatosk_1", ["P001_101_index3", "P001_102_index6"])
+        state.add("102", "ratatosk_2", ["P001_103_index7"])
+        loaded = JobState(os.path.join("tmp", "ratatosk-jobs.json"))
+        loaded.load()
+        self.assertEqual(loaded.jobids(), ["101", "102"])
+        p = progress(loaded, {"101" : "COMPLETED", "102" : "RUNNING"}, now=loaded.submitted + 3600)
+        self.assertEqual((p['samples'], p['samples_done'], p['samples_per_hour'], p['finished']), (3, 2, 2.0, False))
+        # Resubmission as array job: samples are counted in their latest job
+        state = JobState(os.path.join("tmp", "ratatosk-jobs.json"))
+        state.load()
+        state.add("103.1", "ratatosk", ["P001_103_index7"], save=False)
+        state.add("103.2", "ratatosk", ["P001_104_index8"])
+        loaded.load()
+        self.assertEqual(loaded.jobids(), ["101", "102", "103.1", "103.2"])
+        self.assertEqual(expand_jobid("103_[2-4,6%2]"), ["103_2", "103_3", "103_4", "103_6"])
+        p = progress(loaded, {"101" : "COMPLETED", "102" : "FAILED", "103_1" : "COMPLETED", "103_2" : "COMPLETED"})
+        self.assertEqual((p['samples'], p['samples_done'], p['samples_failed'], p['finished']), (4, 4, 0, True))
+
     def test_collect_sample_runs(self):
         """Test function that collects sample runs"""
         t = Task(target=os.path.join(self.project, "P001_101_index3", "P001_101_index3.sort.merge.bam"), label=".merge", suffix=".bam")
         bam_list = collect_sample_runs(t)
         self.assertEqual('P001_101_index3_TGACCA_L001.sort.bam', os.path.basename(sorted(bam_list)[0]))
 
+    def test_collect_sample_runs_global_targets(self):
+        """Test collecting sample runs from global targets via lookup tables"""
+        backend.__global_vars__["targets"] = target_generator(indir=self.project)
+        try:
+            lookup = targets_lookup()
+            self.assertEqual(sorted(lookup['sample'].keys()), ['P001_101_index3', 'P001_102_index6'])
+            t = Task(target=os.path.join(self.project, "P001_101_index3", "P001_101_index3.sort.merge.bam"), label=".merge", suffix=".bam")
+            self.assertEqual(len(collect_sample_runs(t)), 3)
+            backend.__global_vars__["targets"] = [x for x in backend.__global_vars__["targets"] if x.sample_id() == 'P001_102_index6']
+            self.assertEqual(sorted(targets_lookup()['sample'].keys()), ['P001_102_index6'])
+        finally:
+            del backend.__global_vars__["targets"]
+
+    def test_generic_collect_sample_runs_cache(self):
+        """Test that generic_collect_sample_runs memoizes sample runs"""
+        invalidate_sample_runs_cache()
+        t = Task(target=os.path.join(self.project, "P001_101_index3", "P001_101_index3.sort.merge.bam"), label=".merge", suffix=".bam")
+        bam_list = generic_collect_sample_runs(t)
+        self.assertEqual(len(_sample_runs_cache), 1)
+        self.assertEqual(sorted(bam_list), sorted(generic_collect_sample_runs(t)))
+        invalidate_sample_runs_cache(self.project)
+        self.assertEqual(len(_sample_runs_cache), 0)
+
     def test_collect_vcf_files(self):
         """Test function that collects vcf files"""
         t = Task(target=os.path.join(self.project, "CombineVariants.vcf"), suffix=".vcf", label="", add_label=".sort.merge",
                  parent_task=ratatosk.lib.files.input.InputVcfFile)
         vcf_list = collect_vcf_files(t)
         self.assertEqual("P001_101_index3.sort.merge.vcf", os.path.basename(sorted(vcf_list)[0]))
+
+    def test_chunk_targets(self):
+        """Test generating chunk-level targets"""
+        tl = generic_target_generator(indir=self.project, sample=[self.sample], chunks=True)
+        self.assertEqual(sorted([(os.path.basename(x.prefix("sample_run")), x.chunk) for x in tl]),
+                         [("P001_101_index3_TGACCA_L001", "001"), ("P001_101_index3_TGACCA_L001", "001"), ("P001_101_index3_TGACCA_L002", "002")])
+        self.assertEqual([len(fastq_files(x)) for x in tl], [2, 2, 2])
+        self.assertEqual(split_chunk_prefix(tl[0].chunk_prefix()), (tl[0].prefix("sample_run"), tl[0].chunk))
+        self.assertEqual(split_chunk_prefix("P001_101_index3_TGACCA_L001"), ("P001_101_index3_TGACCA_L001", None))
+        prefix = [x.prefix("sample_run") for x in tl if x.chunk == "002"][0]
+        os.makedirs("tmp")
+        write_manifest(os.path.join("tmp", "targets.json"), tl)
+        try:
+            self.assertEqual([(x.prefix("sample_run"), x.chunk) for x in load_manifest(os.path.join("tmp", "targets.json"))],
+                             [(x.prefix("sample_run"), x.chunk) for x in tl])
+            self.assertEqual(run_chunks(prefix), ["002"])
+        finally:
+            del backend.__global_vars__["manifest"]
+            del backend.__global_vars__["targets"]
+        self.assertEqual(run_chunks(prefix), ["002"])
+
+    def test_bench_parse_times(self):
+        """Test parsing benchmark times from output with stray lines"""
+        self.assertEqual(_parse_times("INFO: luigi banner\nratatosk-bench: 0.5 1.5\n"), [0.5, 1.5])
+        self.assertEqual(_parse_times("ratatosk-bench: 1.0\nDEBUG 2\nratatosk-bench: 0.25\n"), [0.25])
+        self.assertIsNone(_parse_times("0.5\n"))
+        self.assertIsNone(_parse_times("ratatosk-bench: done\n"))